@@ -1,9 +1,17 @@
 from dataclasses import dataclass, field
 from datetime import datetime
 
-from pydantic_ai import Agent, RunContext, Tool
-
-from deps.agent_factory import AgentFactory
+from pydantic_ai import Agent, ModelRetry, RunContext, Tool
+
+from agents.registry import agent_registry
+from agents.scheduler import Priority, llm_scheduler
+from deps.agent_factory import (
+    AgentFactory,
+    AgentTask,
+    AgentTaskResult,
+    PlanNode,
+    PlanNodeResult,
+)
 
 
 @dataclass
@@ -12,13 +20,16 @@ class FactoryDeps:
 
 
 orchestrator = Agent(
-    "openai:gpt-4o",
+    agent_registry.model("openai:gpt-4o"),
     deps_type=FactoryDeps,
     name="orchestrator",
     system_prompt="""You are the multiple agent orchestrator.
     You should assign any task to the agents to execute instruction.
     If you want to know available agents, you can get the agent names.
     If you want to run the agent, you can run the agent with the agent name and the instruction.
+    If the task needs several agents, run them at once with run_agents instead of one by one.
+    If some agents need the output of others, plan the whole task once and execute it with run_plan.
+    In a plan node's instruction, write {node_id} where the output of a dependency should go.
 
     You can also create the new instant agent.
     If you want to create the agent, you can create the agent with the agent name, system prompt and available tools by tool_names.
@@ -37,6 +48,23 @@ async def run_agent(ctx: RunContext[FactoryDeps], agent_name: str, instruction:
     return await ctx.deps.factory.run_agent(agent_name, instruction)
 
 
+@orchestrator.tool
+async def run_agents(
+    ctx: RunContext[FactoryDeps], tasks: list[AgentTask]
+) -> list[AgentTaskResult]:
+    """Run several agents concurrently, each task is an agent name and its instruction."""
+    return await ctx.deps.factory.run_agents(tasks)
+
+
+@orchestrator.tool
+async def run_plan(ctx: RunContext[FactoryDeps], nodes: list[PlanNode]) -> list[PlanNodeResult]:
+    """Execute a task graph: each node runs an agent once the nodes in depends_on are done."""
+    try:
+        return await ctx.deps.factory.run_plan(nodes)
+    except ValueError as e:
+        raise ModelRetry(f"Invalid plan: {e}")
+
+
 @orchestrator.tool
 async def create_agent(ctx: RunContext[FactoryDeps], agent_name: str, system_prompt: str) -> Agent:
     return await ctx.deps.factory.create_agent(agent_name, system_prompt)
@@ -54,11 +82,13 @@ def get_weather(_: RunContext):
 
 async def run_orchestrator_sample() -> str:
     default_agents = {
-        "get_today": Agent("openai:gpt-4o-mini", tools=[Tool(get_today)]),
-        "get_weather": Agent("openai:gpt-4o-mini", tools=[Tool(get_weather)]),
+        "get_today": agent_registry.get("openai:gpt-4o-mini", tools=[Tool(get_today)]),
+        "get_weather": agent_registry.get("openai:gpt-4o-mini", tools=[Tool(get_weather)]),
     }
     deps = FactoryDeps(factory=AgentFactory(agents=default_agents))
-    return await orchestrator.run(
+    return await llm_scheduler.run(
+        orchestrator,
         "Respond today's date and weather.",
+        priority=Priority.BATCH,
         deps=deps,
     )
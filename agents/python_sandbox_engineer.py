@@ -1,5 +1,8 @@
 from pydantic_ai import Agent, Tool
 
+from agents.registry import agent_registry
+from agents.scheduler import Priority, llm_scheduler
+
 from tools.python_sandbox import (
     execute_script_and_output_stdout,
     get_file_paths,
@@ -15,7 +18,7 @@ tools = [
 ]
 
 python_sandbox_engineer = Agent(
-    "openai:gpt-4o",
+    agent_registry.model("openai:gpt-4o"),
     tools=tools,
     system_prompt="""You are the Python engineer.
     you can get the file paths in the allowed workspace directory.
@@ -29,9 +32,11 @@ python_sandbox_engineer = Agent(
 
 
 async def run_python_engineer_sample() -> str:
-    return await python_sandbox_engineer.run(
+    return await llm_scheduler.run(
+        python_sandbox_engineer,
         """id, name, price, materials, factory_idをもつproductテーブルと、
         id, name, locationをもつfactoryテーブルがあります。materialはproductテーブルを使います。
         サンプルデータを用意して、polarsでprice順に並び替えて出力するコードを書いてください。
-        """
+        """,
+        priority=Priority.BATCH,
     )
@@ -0,0 +1,228 @@
+import asyncio
+import gc
+import sys
+import time
+from collections.abc import Callable, Hashable, Sequence
+from dataclasses import dataclass, field
+from types import FunctionType, ModuleType
+
+import httpx
+import logfire
+from pydantic_ai import Agent, Tool
+from pydantic_ai.models import KnownModelName, Model, infer_model
+
+from config import settings
+
+# cheap endpoints used to open a pooled connection (DNS + TLS) before the first request
+WARMUP_URLS = {
+    "openai": "https://api.openai.com/v1/models",
+    "gemini": "https://generativelanguage.googleapis.com/v1beta/models",
+    "anthropic": "https://api.anthropic.com/v1/messages",
+}
+
+
+def provider_of(model_name: str) -> str | None:
+    if model_name.startswith("openai:"):
+        return "openai"
+    if model_name.startswith("gemini"):
+        return "gemini"
+    if model_name.startswith("claude"):
+        return "anthropic"
+    return None
+
+
+@dataclass
+class RegisteredAgent:
+    agent: Agent
+    model_name: str
+    created_at: float = field(default_factory=time.monotonic)
+    last_used: float = field(default_factory=time.monotonic)
+    hits: int = 0
+
+
+class AgentRegistry:
+    """Process-wide agents and models, built once and shared by every session.
+
+    Agents are keyed by (model, name, system prompt, tools). All models of a
+    provider share one pooled httpx client, so sessions reuse warm connections
+    instead of opening their own. Agents unused for idle_ttl seconds are dropped
+    by the background evictor, models and clients live for the process:
+    module-level agents hold the models, so aclose() only drops the pooled
+    connections and the same clients reconnect on their next request.
+    """
+
+    def __init__(
+        self,
+        idle_ttl: float = 30 * 60,
+        evict_interval: float = 60,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+    ):
+        self.idle_ttl = idle_ttl
+        self.evict_interval = evict_interval
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=60,
+        )
+        self._clients: dict[str, httpx.AsyncClient] = {}
+        self._transports: dict[str, httpx.AsyncHTTPTransport] = {}
+        self._models: dict[str, Model] = {}
+        self._names: dict[int, str] = {}
+        self._agents: dict[Hashable, RegisteredAgent] = {}
+        self._evictor: asyncio.Task | None = None
+
+    def http_client(self, provider: str) -> httpx.AsyncClient:
+        client = self._clients.get(provider)
+        if client is None or client.is_closed:
+            transport = self._transports[provider] = httpx.AsyncHTTPTransport(limits=self.limits)
+            # same timeouts as pydantic-ai's cached client
+            client = self._clients[provider] = httpx.AsyncClient(
+                transport=transport, timeout=httpx.Timeout(timeout=600, connect=5)
+            )
+        return client
+
+    def model(self, model_name: KnownModelName | str) -> Model:
+        model = self._models.get(model_name)
+        if model is None:
+            model = self._models[model_name] = self._build_model(model_name)
+            self._names[id(model)] = model_name
+        return model
+
+    def name_of(self, model: Model | str | None) -> str | None:
+        """Registry name of a model built here, None for models built elsewhere."""
+        if isinstance(model, str):
+            return model
+        return self._names.get(id(model))
+
+    def get(
+        self,
+        model_name: KnownModelName | str,
+        *,
+        name: str | None = None,
+        system_prompt: str | Sequence[str] = (),
+        tools: Sequence[Tool | Callable] = (),
+        **kwargs,
+    ) -> Agent:
+        """Shared agent for this configuration, built on first use.
+
+        kwargs (deps_type, result_type, ...) are passed to Agent and must be hashable.
+        """
+        prompts = (system_prompt,) if isinstance(system_prompt, str) else tuple(system_prompt)
+        functions = tuple(tool.function if isinstance(tool, Tool) else tool for tool in tools)
+        key = (model_name, name, prompts, functions, tuple(sorted(kwargs.items())))
+        entry = self._agents.get(key)
+        if entry is None:
+            agent = Agent(
+                self.model(model_name),
+                name=name,
+                system_prompt=prompts,
+                tools=list(tools),
+                **kwargs,
+            )
+            entry = self._agents[key] = RegisteredAgent(agent, model_name)
+        entry.last_used = time.monotonic()
+        entry.hits += 1
+        return entry.agent
+
+    async def warmup(self, model_names: Sequence[str]) -> None:
+        """Build the models and open one connection per provider ahead of traffic."""
+        for name in model_names:
+            self.model(name)
+        providers = sorted({provider_of(name) for name in model_names} & WARMUP_URLS.keys())
+        with logfire.span("warm up agent registry", providers=providers):
+            await asyncio.gather(*(self._warmup(provider) for provider in providers))
+
+    def evict_idle(self) -> int:
+        cutoff = time.monotonic() - self.idle_ttl
+        idle = [key for key, entry in self._agents.items() if entry.last_used < cutoff]
+        for key in idle:
+            del self._agents[key]
+        return len(idle)
+
+    def stats(self) -> dict[str, dict]:
+        """Per model: agents, lookups and approximate bytes held by the model and its agents."""
+        stats: dict[str, dict] = {}
+        for name, model in self._models.items():
+            stats[name] = {"agents": 0, "hits": 0, "approx_bytes": approximate_size(model)}
+        for entry in self._agents.values():
+            model_stats = stats[entry.model_name]
+            model_stats["agents"] += 1
+            model_stats["hits"] += entry.hits
+            model_stats["approx_bytes"] += approximate_size(entry.agent)
+        return stats
+
+    def start(self) -> None:
+        if self._evictor is None or self._evictor.done():
+            self._evictor = asyncio.create_task(self._evict_loop(), name="agent_registry")
+
+    async def aclose(self) -> None:
+        if self._evictor is not None:
+            self._evictor.cancel()
+            self._evictor = None
+        # closing the transport only drops its connections (tied to this event loop),
+        # the clients stay usable for models and agents that outlive the lifespan
+        await asyncio.gather(*(transport.aclose() for transport in self._transports.values()))
+
+    def _build_model(self, model_name: str) -> Model:
+        provider = provider_of(model_name)
+        if provider == "openai":
+            from pydantic_ai.models.openai import OpenAIModel
+
+            return OpenAIModel(
+                model_name.removeprefix("openai:"),
+                api_key=settings.openai_api_key,
+                http_client=self.http_client(provider),
+            )
+        if provider == "gemini":
+            from pydantic_ai.models.gemini import GeminiModel
+
+            return GeminiModel(
+                model_name, api_key=settings.gemini_api_key, http_client=self.http_client(provider)
+            )
+        if provider == "anthropic":
+            from pydantic_ai.models.anthropic import AnthropicModel
+
+            return AnthropicModel(
+                model_name,
+                api_key=settings.anthropic_api_key,
+                http_client=self.http_client(provider),
+            )
+        return infer_model(model_name)
+
+    async def _warmup(self, provider: str) -> None:
+        try:
+            # any status will do, the point is the pooled connection
+            await self.http_client(provider).head(WARMUP_URLS[provider])
+        except httpx.HTTPError as e:
+            logfire.warn("warmup of {provider} failed: {e}", provider=provider, e=str(e))
+
+    async def _evict_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.evict_interval)
+            evicted = self.evict_idle()
+            if evicted:
+                logfire.info("evicted {count} idle agents", count=evicted)
+
+
+def approximate_size(obj: object) -> int:
+    """Bytes reachable from obj, not following modules, classes, functions or http clients.
+
+    Those are shared process-wide and would otherwise be counted for every agent.
+    """
+    seen = set()
+    size = 0
+    pending = [obj]
+    while pending:
+        current = pending.pop()
+        if id(current) in seen or isinstance(
+            current, ModuleType | type | FunctionType | httpx.AsyncClient
+        ):
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current)
+        pending.extend(gc.get_referents(current))
+    return size
+
+
+agent_registry = AgentRegistry()
@@ -0,0 +1,240 @@
+import hashlib
+import time
+from collections import Counter, OrderedDict
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+
+import logfire
+import numpy as np
+import pydantic_core
+from diskcache import Cache
+from openai import AsyncOpenAI
+from pydantic_ai import Agent
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelRequest,
+    ModelResponse,
+    SystemPromptPart,
+    UserPromptPart,
+)
+from pydantic_ai.result import Cost, RunResult
+
+from agents.registry import agent_registry
+from agents.scheduler import llm_scheduler
+from config import settings
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+Embedder = Callable[[str], Awaitable[np.ndarray]]
+
+
+@dataclass
+class CachePolicy:
+    ttl: float = 3600
+    # cosine similarity above which a cached answer is reused, None: exact tier only
+    semantic_threshold: float | None = 0.95
+
+
+@dataclass
+class SemanticEntry:
+    embedding: np.ndarray
+    answer: str
+    expires_at: float
+
+
+_openai: AsyncOpenAI | None = None
+
+
+async def openai_embed(text: str) -> np.ndarray:
+    global _openai
+    if _openai is None:
+        _openai = AsyncOpenAI(
+            api_key=settings.openai_api_key, http_client=agent_registry.http_client("openai")
+        )
+    response = await _openai.embeddings.create(input=text, model=EMBEDDING_MODEL)
+    return np.asarray(response.data[0].embedding, dtype=np.float32)
+
+
+class ResponseCache:
+    """Opt-in answer cache for tool-free agent runs that are deterministic for a given input.
+
+    The exact tier is keyed by a hash of (model, system prompts, message history,
+    prompt) and kept in an in-process LRU in front of diskcache. The semantic
+    tier only covers runs without history: it keeps query embeddings per
+    (model, system prompts) and reuses the answer of the most similar cached
+    query above the agent's threshold. Both tiers expire entries after the
+    agent's ttl. Only plain text results are cached.
+    """
+
+    def __init__(
+        self,
+        directory: str = "/tmp/agent_response_cache",
+        memory_size: int = 1024,
+        semantic_size: int = 2048,
+        disk_size_limit: int = 256 * 1024 * 1024,
+        embed: Embedder = openai_embed,
+    ):
+        self.memory_size = memory_size
+        self.semantic_size = semantic_size
+        self.embed = embed
+        self._policies: dict[int, CachePolicy] = {}
+        self._memory: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._semantic: dict[str, OrderedDict[str, SemanticEntry]] = {}
+        self._disk = Cache(
+            directory, size_limit=disk_size_limit, eviction_policy="least-recently-used"
+        )
+        self._results: Counter[tuple[str, str]] = Counter()
+        self._requests = logfire.metric_counter(
+            "agent_cache.requests", unit="1", description="Agent response cache lookups by result"
+        )
+
+    def enable(
+        self, agent: Agent, ttl: float = 3600, semantic_threshold: float | None = 0.95
+    ) -> Agent:
+        """Cache agent's answers. Only for agents whose answer depends on the prompt alone.
+
+        Tools and dynamic system prompts see deps and the outside world, which
+        the cache key does not cover, so those agents are rejected.
+        """
+        if agent._function_tools or agent._system_prompt_functions:
+            raise ValueError(
+                f"Agent {agent.name or ''!r} has tools or dynamic system prompts,"
+                " its answers cannot be cached"
+            )
+        self._policies[id(agent)] = CachePolicy(ttl, semantic_threshold)
+        return agent
+
+    def disable(self, agent: Agent) -> None:
+        self._policies.pop(id(agent), None)
+
+    async def run(
+        self,
+        agent: Agent,
+        user_prompt: str,
+        *,
+        message_history: list[ModelMessage] | None = None,
+        **kwargs,
+    ) -> RunResult:
+        """llm_scheduler.run behind the cache, agents without a policy are not cached."""
+        policy = self._policies.get(id(agent))
+        if policy is None:
+            return await llm_scheduler.run(
+                agent, user_prompt, message_history=message_history, **kwargs
+            )
+
+        model = agent_registry.name_of(kwargs.get("model") or agent.model) or repr(agent.model)
+        scope = digest([model, agent._system_prompts])
+        key = digest([scope, message_history or [], user_prompt])
+
+        answer, result = self._get(key), "exact_hit"
+        embedding = None
+        if answer is None and policy.semantic_threshold is not None and not message_history:
+            try:
+                embedding = await self.embed(normalize(user_prompt))
+            except Exception:
+                # the semantic tier is an optimisation, never fail the run over it
+                logfire.exception("response cache embedding failed")
+            else:
+                answer = self._search(scope, embedding, policy.semantic_threshold)
+                result = "semantic_hit"
+        if answer is not None:
+            self._record(agent, result)
+            return cached_result(agent, user_prompt, message_history, answer)
+
+        self._record(agent, "miss")
+        run = await llm_scheduler.run(agent, user_prompt, message_history=message_history, **kwargs)
+        if isinstance(run.data, str):
+            self._put(key, run.data, policy.ttl)
+            if embedding is not None:
+                self._add_semantic(scope, key, embedding, run.data, policy.ttl)
+        return run
+
+    def stats(self) -> dict[str, dict]:
+        """Per agent lookups by result and hit rate."""
+        stats: dict[str, dict] = {}
+        for (agent, result), count in self._results.items():
+            stats.setdefault(agent, Counter())[result] = count
+        return {
+            agent: {**counts, "hit_rate": 1 - counts["miss"] / counts.total()}
+            for agent, counts in stats.items()
+        }
+
+    def _get(self, key: str) -> str | None:
+        entry = self._memory.get(key)
+        if entry is not None and entry[1] > time.time():
+            self._memory.move_to_end(key)
+            return entry[0]
+        data, expire_time = self._disk.get(key, expire_time=True)
+        if data is None:
+            return None
+        self._remember(key, data, expire_time or float("inf"))
+        return data
+
+    def _put(self, key: str, answer: str, ttl: float) -> None:
+        self._remember(key, answer, time.time() + ttl)
+        self._disk.set(key, answer, expire=ttl)
+
+    def _remember(self, key: str, answer: str, expires_at: float) -> None:
+        self._memory[key] = (answer, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _search(self, scope: str, embedding: np.ndarray, threshold: float) -> str | None:
+        entries = self._semantic.get(scope)
+        if not entries:
+            return None
+        now = time.time()
+        for key in [key for key, entry in entries.items() if entry.expires_at <= now]:
+            del entries[key]
+        if not entries:
+            return None
+        keys = list(entries)
+        similarity = np.stack([entries[key].embedding for key in keys]) @ unit(embedding)
+        best = int(np.argmax(similarity))
+        if similarity[best] < threshold:
+            return None
+        entries.move_to_end(keys[best])
+        return entries[keys[best]].answer
+
+    def _add_semantic(
+        self, scope: str, key: str, embedding: np.ndarray, answer: str, ttl: float
+    ) -> None:
+        entries = self._semantic.setdefault(scope, OrderedDict())
+        entries[key] = SemanticEntry(unit(embedding), answer, time.time() + ttl)
+        entries.move_to_end(key)
+        while len(entries) > self.semantic_size:
+            entries.popitem(last=False)
+
+    def _record(self, agent: Agent, result: str) -> None:
+        name = agent.name or "agent"
+        self._results[(name, result)] += 1
+        self._requests.add(1, {"agent": name, "result": result})
+
+
+def digest(value: object) -> str:
+    return hashlib.sha256(pydantic_core.to_json(value)).hexdigest()
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.split()).casefold()
+
+
+def unit(vector: np.ndarray) -> np.ndarray:
+    return vector / (np.linalg.norm(vector) or 1.0)
+
+
+def cached_result(
+    agent: Agent, user_prompt: str, message_history: list[ModelMessage] | None, answer: str
+) -> RunResult:
+    """RunResult shaped like a real run, so callers can persist new_messages() as usual."""
+    history = list(message_history or [])
+    parts = [] if history else [SystemPromptPart(p) for p in agent._system_prompts]
+    messages = [
+        *history,
+        ModelRequest(parts=[*parts, UserPromptPart(user_prompt)]),
+        ModelResponse.from_text(answer),
+    ]
+    return RunResult(messages, len(history), answer, Cost())
+
+
+response_cache = ResponseCache()
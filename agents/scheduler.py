@@ -0,0 +1,371 @@
+import asyncio
+import statistics
+import time
+from collections import deque
+from collections.abc import AsyncIterator, Callable, Sequence
+from contextlib import AsyncExitStack, asynccontextmanager
+from dataclasses import dataclass, field
+from enum import IntEnum
+from itertools import count
+
+import logfire
+import pydantic_core
+from pydantic_ai import Agent
+from pydantic_ai.exceptions import UnexpectedModelBehavior
+from pydantic_ai.messages import ModelMessage
+from pydantic_ai.models import Model
+from pydantic_ai.result import RunResult, StreamedRunResult
+
+from agents.registry import agent_registry, provider_of
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BATCH = 10
+
+
+# models a run may be routed to instead of the one asked for, in preference order
+EQUIVALENT_MODELS = [
+    ["openai:gpt-4o", "gemini-1.5-pro", "claude-3-5-sonnet-latest"],
+    ["gemini-1.5-flash", "openai:gpt-4o-mini", "claude-3-5-haiku-latest"],
+]
+
+
+@dataclass
+class ProviderLimits:
+    requests_per_minute: float
+    tokens_per_minute: float
+
+
+PROVIDER_LIMITS = {
+    "openai": ProviderLimits(requests_per_minute=500, tokens_per_minute=30_000),
+    "gemini": ProviderLimits(requests_per_minute=360, tokens_per_minute=4_000_000),
+    "anthropic": ProviderLimits(requests_per_minute=50, tokens_per_minute=40_000),
+}
+# tokens reserved for the reply until the run reports what it actually used
+RESPONSE_TOKENS = 1024
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def delay(self, amount: float) -> float:
+        """Seconds until amount can be taken, 0 if it can be taken now."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount: float) -> None:
+        # may go negative when a run used more than was reserved, later callers wait for it
+        self._refill()
+        self.tokens -= amount
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+@dataclass
+class ModelHealth:
+    latencies: deque[float] = field(default_factory=lambda: deque(maxlen=50))
+    failures: int = 0
+    cooldown_until: float = 0.0
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.cooldown_until
+
+    def latency(self) -> float | None:
+        return statistics.median(self.latencies) if self.latencies else None
+
+
+@dataclass(order=True)
+class Waiter:
+    priority: int
+    seq: int
+    candidates: list[str] = field(compare=False)
+    tokens: int = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+
+
+class RateLimited(Exception):
+    pass
+
+
+class LLMScheduler:
+    """Routes agent runs to models under per-provider rate limits.
+
+    Each provider has token buckets for requests and tokens per minute. Runs
+    wait in a priority queue (interactive before batch) and are granted the
+    equivalent model with the lowest rolling median latency whose provider has
+    capacity now. Models that return 429 or keep failing cool down and their
+    runs fail over to the next equivalent model.
+    """
+
+    def __init__(
+        self,
+        model_factory: Callable[[str], Model] = agent_registry.model,
+        equivalents: Sequence[Sequence[str]] = EQUIVALENT_MODELS,
+        limits: dict[str, ProviderLimits] = PROVIDER_LIMITS,
+        rate_limit_cooldown: float = 20.0,
+        failure_cooldown: float = 30.0,
+        max_failures: int = 3,
+    ):
+        self.model_factory = model_factory
+        self.equivalents = [list(group) for group in equivalents]
+        self.limits = limits
+        self.rate_limit_cooldown = rate_limit_cooldown
+        self.failure_cooldown = failure_cooldown
+        self.max_failures = max_failures
+        self._requests = {p: TokenBucket(l.requests_per_minute) for p, l in limits.items()}
+        self._tokens = {p: TokenBucket(l.tokens_per_minute) for p, l in limits.items()}
+        self._health: dict[str, ModelHealth] = {}
+        self._queue: list[Waiter] = []
+        self._seq = count()
+        self._wakeup = asyncio.Event()
+        self._dispatcher: asyncio.Task | None = None
+
+    async def run(
+        self,
+        agent: Agent,
+        user_prompt: str,
+        *,
+        model: str | None = None,
+        priority: Priority = Priority.INTERACTIVE,
+        message_history: list[ModelMessage] | None = None,
+        **kwargs,
+    ) -> RunResult:
+        """agent.run on model or an equivalent, with queuing and failover.
+
+        model defaults to the agent's own registry model. Agents on models the
+        registry did not build (e.g. FunctionModel) run directly.
+        """
+        model = model or agent_registry.name_of(agent.model)
+        if model is None:
+            return await agent.run(user_prompt, message_history=message_history, **kwargs)
+        tokens = estimate_run_tokens(user_prompt, message_history)
+        excluded: set[str] = set()
+        while True:
+            name = await self.acquire(model, tokens, priority, excluded)
+            start = time.monotonic()
+            try:
+                result = await agent.run(
+                    user_prompt,
+                    message_history=message_history,
+                    model=self.model_factory(name),
+                    **kwargs,
+                )
+            except Exception as e:
+                if not self._failed(name, e, excluded):
+                    raise
+                continue
+            self._succeeded(name, time.monotonic() - start, tokens, result.cost().total_tokens)
+            return result
+
+    @asynccontextmanager
+    async def run_stream(
+        self,
+        agent: Agent,
+        user_prompt: str,
+        *,
+        model: str | None = None,
+        priority: Priority = Priority.INTERACTIVE,
+        message_history: list[ModelMessage] | None = None,
+        **kwargs,
+    ) -> AsyncIterator[StreamedRunResult]:
+        """agent.run_stream with the same routing, failover only before the stream starts.
+
+        Latency is recorded as time to the first response, the token reservation
+        is corrected with the run's usage once the caller is done with the stream.
+        """
+        model = model or agent_registry.name_of(agent.model)
+        if model is None:
+            async with agent.run_stream(
+                user_prompt, message_history=message_history, **kwargs
+            ) as result:
+                yield result
+            return
+        tokens = estimate_run_tokens(user_prompt, message_history)
+        excluded: set[str] = set()
+        while True:
+            name = await self.acquire(model, tokens, priority, excluded)
+            start = time.monotonic()
+            async with AsyncExitStack() as stack:
+                try:
+                    result = await stack.enter_async_context(
+                        agent.run_stream(
+                            user_prompt,
+                            message_history=message_history,
+                            model=self.model_factory(name),
+                            **kwargs,
+                        )
+                    )
+                except Exception as e:
+                    if not self._failed(name, e, excluded):
+                        raise
+                    continue
+                self._succeeded(name, time.monotonic() - start, tokens, None)
+                try:
+                    yield result
+                finally:
+                    # partial usage if the caller stopped early
+                    self._charge(name, tokens, result.cost().total_tokens)
+                return
+
+    async def acquire(
+        self, model: str, tokens: int, priority: Priority, excluded: set[str] = frozenset()
+    ) -> str:
+        """Wait for capacity, returns the model name the run was granted."""
+        candidates = [model] + [m for m in self.equivalents_of(model) if m != model]
+        candidates = [m for m in candidates if m not in excluded]
+        if not candidates:
+            raise RateLimited(f"No healthy model left for {model}")
+        future = asyncio.get_running_loop().create_future()
+        waiter = Waiter(priority, next(self._seq), candidates, tokens, future)
+        self._queue.append(waiter)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch(), name="llm_scheduler")
+        self._wakeup.set()
+        with logfire.span("wait for {model} capacity", model=model, priority=priority.name):
+            return await waiter.future
+
+    def equivalents_of(self, model: str) -> list[str]:
+        for group in self.equivalents:
+            if model in group:
+                return group
+        return [model]
+
+    def stats(self) -> dict[str, dict]:
+        now = time.monotonic()
+        return {
+            name: {
+                "median_latency_s": health.latency(),
+                "samples": len(health.latencies),
+                "healthy": health.healthy(now),
+            }
+            for name, health in self._health.items()
+        }
+
+    async def _dispatch(self) -> None:
+        while True:
+            self._wakeup.clear()
+            delay = self._grant_ready()
+            if not self._queue:
+                await self._wakeup.wait()
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except TimeoutError:
+                pass
+
+    def _grant_ready(self) -> float:
+        """Grant every waiter that can start now, returns seconds until one might."""
+        now = time.monotonic()
+        # providers a higher priority waiter is waiting for, lower ones must not take them
+        reserved: set[str | None] = set()
+        remaining: list[Waiter] = []
+        next_delay = 60.0
+        for waiter in sorted(self._queue):
+            if waiter.future.done():
+                continue
+            name, delay = self._choose(waiter, reserved, now)
+            if name is None:
+                remaining.append(waiter)
+                reserved.update(provider_of(m) for m in waiter.candidates)
+                next_delay = min(next_delay, delay)
+                continue
+            provider = provider_of(name)
+            if provider in self._requests:
+                self._requests[provider].take(1)
+                self._tokens[provider].take(waiter.tokens)
+            waiter.future.set_result(name)
+        self._queue = remaining
+        return max(next_delay, 0.01)
+
+    def _choose(
+        self, waiter: Waiter, reserved: set[str | None], now: float
+    ) -> tuple[str | None, float]:
+        def score(item: tuple[int, str]) -> tuple[float, int]:
+            position, name = item
+            # unmeasured models keep their preference order behind measured ones
+            latency = self._health_of(name).latency()
+            return (latency if latency is not None else float("inf"), position)
+
+        delay = 60.0
+        for _, name in sorted(enumerate(waiter.candidates), key=score):
+            health = self._health_of(name)
+            if not health.healthy(now):
+                delay = min(delay, health.cooldown_until - now)
+                continue
+            provider = provider_of(name)
+            if provider in reserved:
+                continue
+            if provider not in self._requests:
+                return name, 0.0
+            wait = max(
+                self._requests[provider].delay(1), self._tokens[provider].delay(waiter.tokens)
+            )
+            if wait == 0:
+                return name, 0.0
+            delay = min(delay, wait)
+        return None, delay
+
+    def _health_of(self, name: str) -> ModelHealth:
+        health = self._health.get(name)
+        if health is None:
+            health = self._health[name] = ModelHealth()
+        return health
+
+    def _succeeded(self, name: str, latency: float, reserved: int, used: int | None) -> None:
+        health = self._health_of(name)
+        health.latencies.append(latency)
+        health.failures = 0
+        self._charge(name, reserved, used)
+
+    def _charge(self, name: str, reserved: int, used: int | None) -> None:
+        """Correct a run's token reservation with what it actually used."""
+        provider = provider_of(name)
+        if used is not None and provider in self._tokens:
+            self._tokens[provider].take(used - reserved)
+
+    def _failed(self, name: str, error: Exception, excluded: set[str]) -> bool:
+        """Record a failed run, True if it should be retried on another model."""
+        health = self._health_of(name)
+        health.failures += 1
+        if is_rate_limit(error):
+            health.cooldown_until = time.monotonic() + self.rate_limit_cooldown
+        elif health.failures >= self.max_failures:
+            health.cooldown_until = time.monotonic() + self.failure_cooldown
+        else:
+            return False
+        logfire.warn("{model} cooling down after {error}", model=name, error=str(error))
+        excluded.add(name)
+        self._wakeup.set()
+        return True
+
+
+def is_rate_limit(error: Exception) -> bool:
+    # openai / anthropic SDK errors carry status_code, gemini raises UnexpectedModelBehavior
+    if getattr(error, "status_code", None) == 429:
+        return True
+    return isinstance(error, UnexpectedModelBehavior) and " 429" in error.message
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count, English text averages ~4 characters per token."""
+    return len(text) // 4 + 1
+
+
+def estimate_run_tokens(user_prompt: str, message_history: list[ModelMessage] | None) -> int:
+    """Tokens to reserve for a run: the prompt and history plus room for the reply."""
+    tokens = estimate_tokens(user_prompt)
+    if message_history:
+        tokens += estimate_tokens(pydantic_core.to_json(message_history).decode())
+    return tokens + RESPONSE_TOKENS
+
+
+llm_scheduler = LLMScheduler()
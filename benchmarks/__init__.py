@@ -0,0 +1,5 @@
+"""
+Package name: benchmarks
+
+This package contains offline benchmarks, they make no LLM or embedding API calls.
+"""
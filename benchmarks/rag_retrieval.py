@@ -0,0 +1,271 @@
+"""Recall / latency benchmark for rag.py retrieval backends.
+
+Everything runs on synthetic clustered embeddings, so no OpenAI calls are made.
+Each configuration prints one JSON line with p50/p95/p99 latency in milliseconds,
+recall@k against exact L2 search and the rate at which the section a query was
+derived from is returned.
+
+Local backends only:
+
+    uv run -m benchmarks.rag_retrieval --sections 20000 --queries 200
+
+Also sweep HNSW parameters and hybrid search against the docker Postgres from rag.py
+(uses a separate `pydantic_ai_rag_bench` database):
+
+    uv run -m benchmarks.rag_retrieval --postgres > bench.jsonl
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import tempfile
+import time
+from collections.abc import Awaitable, Callable, Sequence
+from dataclasses import dataclass
+
+import asyncpg
+import numpy as np
+
+from rag import DB_SCHEMA, LocalVectorIndex, SearchConfig, database_connect, search_doc_sections
+
+BENCH_DATABASE = "pydantic_ai_rag_bench"
+VOCABULARY_SIZE = 5000
+WORDS_PER_SECTION = 60
+WORDS_PER_QUERY = 3
+
+
+@dataclass
+class Corpus:
+    embeddings: np.ndarray
+    titles: list[str]
+    contents: list[str]
+    queries: np.ndarray
+    query_texts: list[str]
+    # section each query was derived from
+    query_sources: np.ndarray
+
+    def urls(self) -> list[str]:
+        return [f"bench://{i}" for i in range(len(self.embeddings))]
+
+
+def make_corpus(
+    sections: int, queries: int, dim: int, clusters: int, noise: float, seed: int
+) -> Corpus:
+    """Clustered unit vectors with cluster-flavoured text, queries are perturbed sections."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    assignment = rng.integers(clusters, size=sections)
+    embeddings = centers[assignment] + noise * rng.standard_normal((sections, dim))
+    embeddings = normalize(embeddings.astype(np.float32))
+
+    words = np.array([f"term{i}" for i in range(VOCABULARY_SIZE)])
+    cluster_words = rng.integers(VOCABULARY_SIZE, size=(clusters, WORDS_PER_SECTION // 2))
+    titles, contents = [], []
+    for i, cluster in enumerate(assignment):
+        own = rng.choice(cluster_words[cluster], WORDS_PER_SECTION // 2)
+        shared = rng.integers(VOCABULARY_SIZE, size=WORDS_PER_SECTION // 2)
+        titles.append(f"section {i} {words[own[0]]}")
+        contents.append(" ".join(words[np.concatenate([own, shared])]))
+
+    sources = rng.integers(sections, size=queries)
+    query_embeddings = embeddings[sources] + noise * rng.standard_normal((queries, dim))
+    query_texts = [
+        " ".join(rng.choice(contents[source].split(), WORDS_PER_QUERY, replace=False))
+        for source in sources
+    ]
+    return Corpus(
+        embeddings=embeddings,
+        titles=titles,
+        contents=contents,
+        queries=normalize(query_embeddings.astype(np.float32)),
+        query_texts=query_texts,
+        query_sources=sources,
+    )
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def exact_neighbours(corpus: Corpus, k: int) -> np.ndarray:
+    norms = np.einsum("ij,ij->i", corpus.embeddings, corpus.embeddings)
+    dist = norms[:, np.newaxis] - 2 * corpus.embeddings @ corpus.queries.T
+    top = np.argpartition(dist, k - 1, axis=0)[:k]
+    order = np.take_along_axis(dist, top, axis=0).argsort(axis=0)
+    return np.take_along_axis(top, order, axis=0).T
+
+
+async def measure(
+    corpus: Corpus,
+    truth: np.ndarray,
+    limit: int,
+    search: Callable[[int], Awaitable[Sequence[int]]],
+) -> dict:
+    """Run every query through `search` sequentially and summarise latency and recall."""
+    latencies, recalls, hits = [], [], []
+    for q in range(len(corpus.queries)):
+        start = time.perf_counter()
+        found = await search(q)
+        latencies.append((time.perf_counter() - start) * 1000)
+        recalls.append(len(set(found) & set(truth[q, :limit])) / limit)
+        hits.append(corpus.query_sources[q] in found)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "limit": limit,
+        "queries": len(latencies),
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "recall": round(float(np.mean(recalls)), 4),
+        "source_hit_rate": round(float(np.mean(hits)), 4),
+    }
+
+
+def emit(backend: str, params: dict, stats: dict) -> None:
+    print(json.dumps({"backend": backend, "params": params, **stats}), flush=True)
+
+
+async def bench_local(
+    corpus: Corpus, truth: np.ndarray, limits: list[int], nlists: list[int], nprobes: list[int]
+) -> None:
+    ids = np.arange(len(corpus.embeddings), dtype=np.int64)
+    sections = [
+        {"url": url, "title": title, "content": content}
+        for url, title, content in zip(corpus.urls(), corpus.titles, corpus.contents)
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        index = LocalVectorIndex(directory)
+        index.replace(ids, sections, corpus.embeddings)
+        for limit in limits:
+
+            async def search_exact(q: int) -> Sequence[int]:
+                [found] = index.search_batch(corpus.queries[q : q + 1], limit)
+                return found.tolist()
+
+            emit("local", {"mode": "exact"}, await measure(corpus, truth, limit, search_exact))
+
+            # batched throughput is what makes the exact backend cheap
+            start = time.perf_counter()
+            index.search_batch(corpus.queries, limit)
+            elapsed = time.perf_counter() - start
+            emit(
+                "local",
+                {"mode": "exact_batch"},
+                {"limit": limit, "queries_per_sec": round(len(corpus.queries) / elapsed, 1)},
+            )
+
+        for nlist in nlists:
+            start = time.perf_counter()
+            ivf = LocalVectorIndex.open(directory, nlist=nlist)
+            train_s = time.perf_counter() - start
+            for nprobe in nprobes:
+                ivf.nprobe = nprobe
+                for limit in limits:
+
+                    async def search_ivf(q: int) -> Sequence[int]:
+                        [found] = ivf.search_batch(corpus.queries[q : q + 1], limit)
+                        return found.tolist()
+
+                    stats = await measure(corpus, truth, limit, search_ivf)
+                    emit(
+                        "local",
+                        {"mode": "ivf", "nlist": nlist, "nprobe": nprobe},
+                        {**stats, "build_s": round(train_s, 3)},
+                    )
+
+
+async def load_postgres(pool: asyncpg.Pool, corpus: Corpus) -> None:
+    async with pool.acquire() as conn:
+        await conn.execute("DROP TABLE IF EXISTS doc_sections")
+        await conn.execute(DB_SCHEMA)
+        await conn.execute("DROP INDEX IF EXISTS idx_doc_sections_embedding")
+        await conn.copy_records_to_table(
+            "doc_sections",
+            records=[
+                (url, title, content, "", embedding)
+                for url, title, content, embedding in zip(
+                    corpus.urls(), corpus.titles, corpus.contents, corpus.embeddings
+                )
+            ],
+            columns=["url", "title", "content", "content_hash", "embedding"],
+        )
+        await conn.execute("ANALYZE doc_sections")
+
+
+async def bench_postgres(
+    corpus: Corpus,
+    truth: np.ndarray,
+    limits: list[int],
+    hnsw_params: list[tuple[int, int]],
+    ef_searches: list[int],
+) -> None:
+    async with database_connect(True, database=BENCH_DATABASE) as pool:
+        await load_postgres(pool, corpus)
+        for m, ef_construction in hnsw_params:
+            start = time.perf_counter()
+            await pool.execute("DROP INDEX IF EXISTS idx_doc_sections_embedding")
+            await pool.execute(
+                "CREATE INDEX idx_doc_sections_embedding ON doc_sections "
+                f"USING hnsw (embedding vector_l2_ops) WITH (m = {m:d}, "
+                f"ef_construction = {ef_construction:d})"
+            )
+            build_s = time.perf_counter() - start
+            for ef_search in ef_searches:
+                for mode in ("vector", "hybrid"):
+                    for limit in limits:
+                        config = SearchConfig(mode=mode, limit=limit, hnsw_ef_search=ef_search)
+
+                        async def search_pg(q: int) -> Sequence[int]:
+                            rows = await search_doc_sections(
+                                pool, corpus.queries[q], corpus.query_texts[q], config
+                            )
+                            return [int(row["url"].removeprefix("bench://")) for row in rows]
+
+                        stats = await measure(corpus, truth, limit, search_pg)
+                        params = {
+                            "mode": mode,
+                            "m": m,
+                            "ef_construction": ef_construction,
+                            "ef_search": ef_search,
+                        }
+                        emit("postgres", params, {**stats, "build_s": round(build_s, 3)})
+
+
+def int_list(value: str) -> list[int]:
+    return [int(v) for v in value.split(",")]
+
+
+def hnsw_list(value: str) -> list[tuple[int, int]]:
+    """`16:64,32:128` -> [(16, 64), (32, 128)]"""
+    return [tuple(int(v) for v in pair.split(":")) for pair in value.split(",")]
+
+
+async def main(args: argparse.Namespace) -> None:
+    corpus = make_corpus(
+        args.sections, args.queries, args.dim, args.clusters, args.noise, args.seed
+    )
+    truth = exact_neighbours(corpus, max(args.limits))
+    await bench_local(corpus, truth, args.limits, args.nlists, args.nprobes)
+    if args.postgres:
+        await bench_postgres(corpus, truth, args.limits, args.hnsw, args.ef_search)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sections", type=int, default=10_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--clusters", type=int, default=100)
+    parser.add_argument("--noise", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--limits", type=int_list, default=[8, 20])
+    parser.add_argument("--nlists", type=int_list, default=[64, 256])
+    parser.add_argument("--nprobes", type=int_list, default=[4, 16])
+    parser.add_argument("--postgres", action="store_true", help="also benchmark pgvector")
+    parser.add_argument("--hnsw", type=hnsw_list, default=[(16, 64), (32, 128)])
+    parser.add_argument("--ef-search", type=int_list, default=[40, 100, 200])
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        sys.exit(1)
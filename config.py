@@ -5,6 +5,10 @@ class Settings(BaseSettings):
     supabase_url: str
     supabase_anon_key: str
     supabase_access_token: str | None = None
+    # legacy HS256 secret, asymmetric tokens are verified against the project's JWKS.
+    # Unset: HS256 tokens are verified by the auth server, once per token
+    supabase_jwt_secret: str | None = None
+    supabase_jwt_audience: str = "authenticated"
     supabase_dev_email: str
     supabase_dev_password: str
     tavily_api_key: str | None = None
@@ -13,6 +17,14 @@ class Settings(BaseSettings):
     anthropic_api_key: str
     neo4j_uri: str
     neo4j_auth: str
+    conversation_cache_max_bytes: int = 64 * 1024 * 1024
+    # diskcache directory shared by workers to invalidate each other's conversation caches
+    conversation_cache_shared_dir: str | None = None
+    # diskcache directory for sessions shared by workers, in-process store when unset
+    session_store_dir: str | None = None
+    session_store_max_sessions: int = 10_000
+    character_cache_dir: str = "/tmp/character_cache"
+    character_cache_ttl: int = 3600
 
     class Config:
         env_file = ".env"
@@ -1,11 +1,123 @@
+import asyncio
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable
+from dataclasses import dataclass
 from typing import Optional
 
-from pydantic import BaseModel, Field
+import logfire
+from pydantic import BaseModel, Field, PrivateAttr
 from pydantic_ai import Agent
 
+from agents.registry import agent_registry
+from agents.response_cache import response_cache
+from agents.scheduler import Priority
+
+
+class AgentTask(BaseModel):
+    agent_name: str
+    instruction: str
+
+
+class AgentTaskResult(BaseModel):
+    agent_name: str
+    ok: bool
+    output: str | None = None
+    error: str | None = None
+    elapsed_s: float
+
+
+class PlanNode(BaseModel):
+    id: str
+    agent_name: str
+    # `{id}` of a dependency is replaced with that dependency's output
+    instruction: str
+    depends_on: list[str] = Field(default_factory=list)
+
+
+class PlanNodeResult(AgentTaskResult):
+    id: str
+    cached: bool = False
+    # seconds since the plan started
+    started_s: float
+    finished_s: float
+    # longest chain of dependencies ending in this node, including its own run
+    critical_path_s: float
+
+
+@dataclass
+class MemoEntry:
+    # held so its id in the key cannot be reused by another agent while the entry lives
+    agent: Agent | None
+    future: asyncio.Future
+    # inf while the run is in flight, ttl after it succeeded
+    expires_at: float = float("inf")
+
+
+class PlanMemo:
+    """Plan node results shared by every AgentFactory, so identical nodes run once across plans.
+
+    Keyed by (agent_name, agent identity, instruction): registry agents are
+    shared, and an agent replaced under the same name (create_agent with a new
+    system prompt) misses. Successful results are reused for ttl seconds, at
+    most size entries are kept (LRU), failures are dropped so a later plan
+    may retry.
+    """
+
+    def __init__(self, ttl: float = 300.0, size: int = 1024):
+        self.ttl = ttl
+        self.size = size
+        self._entries: OrderedDict[tuple[str, int, str], MemoEntry] = OrderedDict()
+
+    def get(self, agent_name: str, agent: Agent | None, instruction: str) -> asyncio.Future | None:
+        key = (agent_name, id(agent), instruction)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        # futures of an earlier event loop (e.g. another asyncio.run) cannot be awaited
+        if (
+            entry.expires_at <= time.monotonic()
+            or entry.future.get_loop() is not asyncio.get_running_loop()
+        ):
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry.future
+
+    def add(
+        self,
+        agent_name: str,
+        agent: Agent | None,
+        instruction: str,
+        run: Awaitable[AgentTaskResult],
+    ) -> asyncio.Future:
+        key = (agent_name, id(agent), instruction)
+        entry = self._entries[key] = MemoEntry(agent, asyncio.ensure_future(run))
+
+        def settled(future: asyncio.Future) -> None:
+            if future.cancelled() or not future.result().ok:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+            else:
+                entry.expires_at = time.monotonic() + self.ttl
+
+        entry.future.add_done_callback(settled)
+        while len(self._entries) > self.size:
+            # waiters of an evicted in-flight run still hold its future
+            self._entries.popitem(last=False)
+        return entry.future
+
+
+plan_memo = PlanMemo()
+
 
 class AgentFactory(BaseModel):
     agents: dict = Field(default_factory=dict)
+    # bounds for run_agents fan-out and plan execution
+    max_concurrency: int = 4
+    timeout_s: float = 60.0
+    # shared by default, factories are built per orchestrator run
+    _memo: PlanMemo = PrivateAttr(default_factory=lambda: plan_memo)
 
     def get_agent_names(self) -> list[str]:
         return list(self.agents.keys())
@@ -14,15 +126,156 @@ class AgentFactory(BaseModel):
         agent: Optional[Agent] = self.agents.get(name)
         if agent:
             assert isinstance(agent, Agent)
-            response = await agent.run(instruction)
+            response = await response_cache.run(agent, instruction, priority=Priority.BATCH)
             return response.data
         return "Agent not found"
 
+    async def run_agents(self, tasks: list[AgentTask]) -> list[AgentTaskResult]:
+        """Run tasks concurrently, results in task order.
+
+        At most max_concurrency run at once and each is cut off after timeout_s.
+        A failed or timed out task is reported in its result instead of cancelling
+        the others, so the wall time is that of the slowest task.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with asyncio.TaskGroup() as group:
+            running = [
+                group.create_task(self._run_task(task.agent_name, task.instruction, semaphore))
+                for task in tasks
+            ]
+        return [task.result() for task in running]
+
+    async def run_plan(self, nodes: list[PlanNode]) -> list[PlanNodeResult]:
+        """Execute a task graph, results in node order.
+
+        Each node starts as soon as its dependencies have succeeded, within the
+        max_concurrency bound. Nodes with the same (agent_name, instruction) after
+        substitution run once, also across plans (see PlanMemo).
+        A node whose dependency failed is skipped and reported as failed.
+        """
+        validate_plan(nodes)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        plan_start = time.perf_counter()
+        done: dict[str, asyncio.Future[PlanNodeResult]] = {}
+
+        async def run(node: PlanNode) -> PlanNodeResult:
+            dependencies = [await done[dependency] for dependency in node.depends_on]
+            started = time.perf_counter()
+            failed = [dependency.id for dependency in dependencies if not dependency.ok]
+            instruction = node.instruction
+            for dependency in dependencies:
+                instruction = instruction.replace(f"{{{dependency.id}}}", dependency.output or "")
+
+            cached = False
+            if failed:
+                result = AgentTaskResult(
+                    agent_name=node.agent_name,
+                    ok=False,
+                    error=f"Skipped, failed dependencies: {', '.join(failed)}",
+                    elapsed_s=0.0,
+                )
+            else:
+                agent = self.agents.get(node.agent_name)
+                memo = self._memo.get(node.agent_name, agent, instruction)
+                cached = memo is not None
+                if memo is None:
+                    memo = self._memo.add(
+                        node.agent_name,
+                        agent,
+                        instruction,
+                        self._run_task(node.agent_name, instruction, semaphore),
+                    )
+                result = await asyncio.shield(memo)
+            finished = time.perf_counter()
+            return PlanNodeResult(
+                **result.model_dump(exclude={"elapsed_s"}),
+                elapsed_s=0.0 if cached else result.elapsed_s,
+                id=node.id,
+                cached=cached,
+                started_s=started - plan_start,
+                finished_s=finished - plan_start,
+                critical_path_s=max((d.critical_path_s for d in dependencies), default=0.0)
+                + (finished - started),
+            )
+
+        async with asyncio.TaskGroup() as group:
+            for node in topological_order(nodes):
+                done[node.id] = group.create_task(run(node))
+        results = [done[node.id].result() for node in nodes]
+        logfire.info(
+            "plan of {count} nodes finished in {elapsed:.2f}s",
+            count=len(nodes),
+            elapsed=time.perf_counter() - plan_start,
+        )
+        return results
+
+    async def _run_task(
+        self, agent_name: str, instruction: str, semaphore: asyncio.Semaphore
+    ) -> AgentTaskResult:
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                if agent_name not in self.agents:
+                    raise LookupError(f"Agent not found: {agent_name}")
+                async with asyncio.timeout(self.timeout_s):
+                    output = await self.run_agent(agent_name, instruction)
+            except TimeoutError:
+                error = f"Timed out after {self.timeout_s}s"
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            else:
+                return AgentTaskResult(
+                    agent_name=agent_name,
+                    ok=True,
+                    output=output,
+                    elapsed_s=time.perf_counter() - start,
+                )
+            return AgentTaskResult(
+                agent_name=agent_name,
+                ok=False,
+                error=error,
+                elapsed_s=time.perf_counter() - start,
+            )
+
     async def create_agent(self, name: str, system_prompt: str) -> Agent:
-        agent = Agent("gemini-1.5-pro", name=name, system_prompt=system_prompt)
+        agent = agent_registry.get("gemini-1.5-pro", name=name, system_prompt=system_prompt)
         self.agents[name] = agent
         return "Success"
 
     async def save_agent(self):
         """Save created agent(system_prompt) to database."""
         pass
+
+
+def validate_plan(nodes: list[PlanNode]) -> None:
+    ids = [node.id for node in nodes]
+    duplicates = {node_id for node_id in ids if ids.count(node_id) > 1}
+    if duplicates:
+        raise ValueError(f"Duplicate node ids: {sorted(duplicates)}")
+    for node in nodes:
+        unknown = set(node.depends_on) - set(ids)
+        if unknown:
+            raise ValueError(f"Node {node.id} depends on unknown nodes: {sorted(unknown)}")
+    topological_order(nodes)
+
+
+def topological_order(nodes: list[PlanNode]) -> list[PlanNode]:
+    """Dependencies before dependents, raises ValueError on cycles."""
+    by_id = {node.id: node for node in nodes}
+    order: list[PlanNode] = []
+    state: dict[str, str] = {}
+
+    def visit(node_id: str, path: list[str]) -> None:
+        if state.get(node_id) == "done":
+            return
+        if state.get(node_id) == "visiting":
+            raise ValueError(f"Plan has a cycle: {' -> '.join([*path, node_id])}")
+        state[node_id] = "visiting"
+        for dependency in by_id[node_id].depends_on:
+            visit(dependency, [*path, node_id])
+        state[node_id] = "done"
+        order.append(by_id[node_id])
+
+    for node in nodes:
+        visit(node.id, [])
+    return order
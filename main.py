@@ -1,3 +1,5 @@
+from contextlib import asynccontextmanager
+
 import logfire
 from fastapi import FastAPI
 
@@ -5,8 +7,26 @@ from fastapi import FastAPI
 from routers.chat import chat_router
 from routers.supabase import supabase_router
 from routers.char_chat import char_router
+from agents.registry import agent_registry
+from managers.persistence import write_behind
+from managers.auth import token_verifier
+from managers.supabase import AsyncSupabaseManager
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    write_behind.start()
+    await agent_registry.warmup(["gemini-1.5-flash", "gemini-1.5-pro", "openai:gpt-4o"])
+    agent_registry.start()
+    yield
+    # flush queued conversation / entity writes before the worker exits
+    await write_behind.stop()
+    await AsyncSupabaseManager.aclose()
+    await token_verifier.aclose()
+    await agent_registry.aclose()
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 app.include_router(supabase_router)
 app.include_router(chat_router)
 app.include_router(char_router)
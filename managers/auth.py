@@ -0,0 +1,166 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+import httpx
+import jwt
+import logfire
+from fastapi import HTTPException
+
+from config import settings
+
+
+class TokenVerifier:
+    """Verifies Supabase access tokens locally instead of asking the auth server.
+
+    HS256 tokens are checked against the project's JWT secret, asymmetric ones
+    against the keys published at the project's JWKS endpoint, which are cached
+    and refetched every jwks_refresh seconds (or when a token names an unknown
+    kid). Without a secret, HS256 tokens are checked once by the auth server's
+    user endpoint. Decoded claims are memoized per token until the token expires.
+    """
+
+    def __init__(
+        self,
+        secret: str | None = None,
+        jwks_url: str | None = None,
+        user_url: str | None = None,
+        audience: str = "authenticated",
+        jwks_refresh: float = 600.0,
+        max_tokens: int = 10_000,
+        leeway: float = 0.0,
+    ):
+        self.secret = secret
+        self.jwks_url = jwks_url
+        self.user_url = user_url
+        self.audience = audience
+        self.jwks_refresh = jwks_refresh
+        self.max_tokens = max_tokens
+        self.leeway = leeway
+        self._claims: OrderedDict[str, dict] = OrderedDict()
+        self._keys: dict[str, jwt.PyJWK] = {}
+        self._keys_fetched_at = float("-inf")
+        self._keys_lock = asyncio.Lock()
+        self._http: httpx.AsyncClient | None = None
+
+    async def verify(self, token: str) -> dict:
+        """Return the token's claims, raises HTTPException(401) if it is not valid."""
+        claims = self._claims.get(token)
+        if claims is not None:
+            if claims["exp"] + self.leeway > time.time():
+                self._claims.move_to_end(token)
+                return claims
+            del self._claims[token]
+
+        try:
+            header = jwt.get_unverified_header(token)
+            if header.get("alg") == "HS256" and not self.secret:
+                claims = await self._server_claims(token)
+            else:
+                if header.get("alg") == "HS256":
+                    key, algorithm = self.secret, "HS256"
+                else:
+                    signing_key = await self._signing_key(header.get("kid"))
+                    key, algorithm = signing_key.key, signing_key.algorithm_name
+                claims = jwt.decode(
+                    token,
+                    key,
+                    algorithms=[algorithm],
+                    audience=self.audience,
+                    leeway=self.leeway,
+                    options={"require": ["exp", "sub"]},
+                )
+        except jwt.PyJWTError as e:
+            raise HTTPException(status_code=401, detail=f"Invalid or expired token: {e}")
+
+        self._claims[token] = claims
+        while len(self._claims) > self.max_tokens:
+            self._claims.popitem(last=False)
+        return claims
+
+    async def user_id(self, token: str) -> str:
+        return (await self.verify(token))["sub"]
+
+    def forget(self, token: str) -> None:
+        self._claims.pop(token, None)
+
+    async def aclose(self) -> None:
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    def http(self) -> httpx.AsyncClient:
+        if self._http is None or self._http.is_closed:
+            self._http = httpx.AsyncClient(
+                headers={"apikey": settings.supabase_anon_key}, timeout=10.0
+            )
+        return self._http
+
+    async def _server_claims(self, token: str) -> dict:
+        """Claims of a token the auth server accepts, for HS256 tokens without a local secret."""
+        if not self.user_url:
+            raise jwt.InvalidTokenError("HS256 token but no JWT secret or user url is configured")
+        claims = jwt.decode(token, options={"verify_signature": False, "require": ["exp"]})
+        if claims["exp"] + self.leeway <= time.time():
+            raise jwt.ExpiredSignatureError("Signature has expired")
+        try:
+            with logfire.span("verify token with auth server"):
+                response = await self.http().get(
+                    self.user_url, headers={"Authorization": f"Bearer {token}"}
+                )
+        except httpx.HTTPError as e:
+            raise HTTPException(status_code=503, detail=f"Auth server unavailable: {e}")
+        if response.status_code in (401, 403):
+            raise jwt.InvalidTokenError(response.text)
+        if response.is_error:
+            raise HTTPException(status_code=503, detail="Auth server unavailable")
+        # the server is authoritative for the subject
+        return {**claims, "sub": response.json()["id"]}
+
+    async def _signing_key(self, kid: str | None) -> jwt.PyJWK:
+        if kid not in self._keys or self._keys_stale():
+            async with self._keys_lock:
+                # another request may have refreshed the keys while we waited
+                if kid not in self._keys or self._keys_stale():
+                    await self._refresh_keys(force=kid not in self._keys)
+        if kid not in self._keys:
+            raise jwt.InvalidTokenError(f"Unknown signing key: {kid}")
+        return self._keys[kid]
+
+    def _keys_stale(self) -> bool:
+        return time.monotonic() - self._keys_fetched_at > self.jwks_refresh
+
+    async def _refresh_keys(self, force: bool) -> None:
+        # unknown kids trigger a refetch, but at most every few seconds
+        if force and time.monotonic() - self._keys_fetched_at < 5.0:
+            return
+        if not self.jwks_url:
+            raise jwt.InvalidTokenError("Asymmetric token but no JWKS url is configured")
+        try:
+            with logfire.span("fetch jwks"):
+                response = await self.http().get(self.jwks_url)
+                response.raise_for_status()
+        except httpx.HTTPError as e:
+            if not self._keys:
+                # the token may be fine, we just cannot check it yet
+                raise HTTPException(status_code=503, detail=f"Signing keys unavailable: {e}")
+            # keep verifying with the keys we have until the endpoint is back
+            logfire.exception("jwks refresh failed, keeping cached keys")
+            self._keys_fetched_at = time.monotonic()
+            return
+        keys = {}
+        for data in response.json().get("keys", []):
+            try:
+                keys[data.get("kid")] = jwt.PyJWK(data)
+            except jwt.PyJWTError:
+                logfire.warn("skipping unusable jwk: {kid}", kid=data.get("kid"))
+        self._keys = keys
+        self._keys_fetched_at = time.monotonic()
+
+
+token_verifier = TokenVerifier(
+    secret=settings.supabase_jwt_secret,
+    jwks_url=f"{settings.supabase_url}/auth/v1/.well-known/jwks.json",
+    user_url=f"{settings.supabase_url}/auth/v1/user",
+    audience=settings.supabase_jwt_audience,
+)
@@ -1,25 +1,34 @@
+import asyncio
 import json
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
 from dataclasses import dataclass, field
 
 import logfire
-from diskcache import Cache
 from pydantic import BaseModel, Field, model_serializer
 from pydantic_ai import Agent, RunContext
 from pydantic_ai.messages import ModelMessage
-from pydantic_ai.result import RunResult
+from pydantic_ai.models import KnownModelName, Model
+from pydantic_ai.result import RunResult, StreamedRunResult
 
-from managers.supabase import SupabaseManager
+from agents.registry import agent_registry
+from agents.scheduler import llm_scheduler
+from managers.character_cache import character_cache
+from managers.history import HistoryWindow
+from managers.persistence import write_behind
+from managers.supabase import AsyncSupabaseManager
 
 
 @dataclass
 class Deps:
-    supabase: SupabaseManager
-    cache: Cache = Cache("/tmp/mycache")
+    supabase: AsyncSupabaseManager
     title: str = ""
     ai_name: str = ""
     user_name: str = ""
     conversation_id: int | None = None
     message_history: list[ModelMessage] = field(default_factory=list)
+    # character profiles loaded for this run, None for names that have no row
+    characters: dict[str, dict | None] = field(default_factory=dict)
 
 
 class Character(BaseModel):
@@ -31,57 +40,93 @@ class Character(BaseModel):
         return f"{self.name}'s profile: {json.dumps(self.profile)}"
 
 
-cache = Cache("/tmp/mycache")
-
 agent = Agent(
-    "openai:gpt-4o",
+    agent_registry.model("openai:gpt-4o"),
     deps_type=Deps,
     system_prompt="use save tool to save or memorize profile",
 )
 
+# character replies are short, a small window keeps per-turn latency flat
+history_window = HistoryWindow(budget_tokens=6000)
+
 
 @agent.system_prompt
-def get_ai_profile(ctx: RunContext[Deps]) -> str:
-    char = ctx.deps.cache.get(ctx.deps.ai_name)
-    if not char:
-        char_data = ctx.deps.supabase.get_entity("character", ctx.deps.ai_name)
-        char = Character(name=ctx.deps.user_name)
-        char.profile = char_data["profile"] if char_data else {}
-        ctx.deps.cache.set(char.name, char)
+async def get_ai_profile(ctx: RunContext[Deps]) -> str:
+    char = await load_character(ctx.deps, ctx.deps.ai_name)
     return f"# Play a role as {char.name}. Your Personality: {char.model_dump_json()}"
 
 
 @agent.system_prompt
-def get_user_profile(ctx: RunContext[Deps]) -> str:
-    char = ctx.deps.cache.get(ctx.deps.user_name)
-    if not char:
-        char_data = ctx.deps.supabase.get_entity("character", ctx.deps.user_name)
-        logfire.info(f"char_data: {char_data}")
-        char = Character(name=ctx.deps.user_name)
-        char.profile = char_data["profile"] if char_data else {}
-        ctx.deps.cache.set(ctx.deps.user_name, char)
+async def get_user_profile(ctx: RunContext[Deps]) -> str:
+    char = await load_character(ctx.deps, ctx.deps.user_name)
     return f"Recognize User Personality: {char.model_dump_json()}"
 
 
 @agent.tool
-def get_character_profile(ctx: RunContext[Deps], character_name) -> str:
-    char = ctx.deps.cache.get(character_name)
-    if not char:
-        char = ctx.deps.supabase.get_entity("character", character_name)
-        char = Character(**char) if char else Character(name=character_name)
-        ctx.deps.cache.set(char.name, char)
+async def get_character_profile(ctx: RunContext[Deps], character_name) -> str:
+    char = await load_character(ctx.deps, character_name)
     return char.model_dump_json()
 
 
 @agent.tool
 async def udpate_character_profile(ctx: RunContext[Deps], name: str, profile: str):
     """profile: json string"""
-    ctx.deps.supabase.save_entity("character", name, profile)
-    char = Character(name=name, profile={"profile": profile})
-    ctx.deps.cache.set(char.name, char)
+    try:
+        data = json.loads(profile)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        data = {"profile": profile}
+    # write through: the cache and the queued DB write hold the same profile
+    character_cache.put(name, data)
+    ctx.deps.characters[name] = data
+    write_behind.enqueue_entity(ctx.deps.supabase, "character", name, data)
+    char = Character(name=name, profile=data)
     logfire.info(f"Character profile updated: {char}")
     return "Character profile updated"
 
 
+async def load_character(deps: Deps, name: str) -> Character:
+    if name not in deps.characters:
+        deps.characters.update(await character_cache.load(deps.supabase, [name]))
+    return Character(name=name, profile=deps.characters[name] or {})
+
+
+async def prefetch_characters(deps: Deps, names: list[str]) -> None:
+    """Load the characters the first turn's system prompts need, cache misses in one request."""
+    missing = [name for name in names if name not in deps.characters]
+    if missing:
+        deps.characters.update(await character_cache.load(deps.supabase, missing))
+
+
+async def prepare_run(message_history: list[ModelMessage], deps: Deps) -> list[ModelMessage]:
+    if message_history:
+        # system prompts only run on the first turn, later turns do not need the characters
+        return await history_window.apply(deps.conversation_id, message_history)
+    history, _ = await asyncio.gather(
+        history_window.apply(deps.conversation_id, message_history),
+        prefetch_characters(deps, [deps.ai_name, deps.user_name]),
+    )
+    return history
+
+
 async def char_chat(text: str, message_history: list[ModelMessage], deps: Deps) -> RunResult:
-    return await agent.run(text, message_history=message_history, deps=deps)
+    history = await prepare_run(message_history, deps)
+    return await llm_scheduler.run(agent, text, message_history=history, deps=deps)
+
+
+@asynccontextmanager
+async def char_chat_stream(
+    text: str,
+    message_history: list[ModelMessage],
+    deps: Deps,
+    model: Model | KnownModelName | None = None,
+) -> AsyncIterator[StreamedRunResult]:
+    """Streamed char_chat, model overrides the agent's (e.g. a FunctionModel offline)."""
+    history = await prepare_run(message_history, deps)
+    if model is not None:
+        stream = agent.run_stream(text, message_history=history, deps=deps, model=model)
+    else:
+        stream = llm_scheduler.run_stream(agent, text, message_history=history, deps=deps)
+    async with stream as result:
+        yield result
@@ -0,0 +1,123 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+
+import logfire
+from diskcache import Cache
+
+from config import settings
+from managers.supabase import AsyncSupabaseManager, entity_loader
+
+
+@dataclass
+class CachedCharacter:
+    # None: the character has no row, cached so unknown names do not hit Supabase either
+    profile: dict | None
+    version: int
+    expires_at: float
+
+
+class CharacterCache:
+    """Character profiles in an in-process LRU in front of a diskcache shared by workers.
+
+    Entries expire after ttl seconds (negative_ttl for names without a row) and
+    carry a version stamp. Writes go through both tiers and publish the new
+    version, so other workers drop their in-memory copy on their next lookup.
+    Values are plain dicts, not pickled models, so the disk tier survives
+    changes to the Character model.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        memory_size: int = 1024,
+        ttl: float = 3600,
+        negative_ttl: float = 60,
+        disk_size_limit: int = 64 * 1024 * 1024,
+    ):
+        self.memory_size = memory_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._memory: OrderedDict[str, CachedCharacter] = OrderedDict()
+        self._lock = Lock()
+        self._disk = Cache(
+            directory, size_limit=disk_size_limit, eviction_policy="least-recently-used"
+        )
+        self._requests = logfire.metric_counter(
+            "char_cache.requests", unit="1", description="Character cache lookups by result"
+        )
+        self._latency = logfire.metric_histogram(
+            "char_cache.lookup", unit="ms", description="Character cache lookup latency"
+        )
+
+    def get(self, name: str) -> CachedCharacter | None:
+        start = time.perf_counter()
+        entry, result = self._lookup(name)
+        self._requests.add(1, {"result": result})
+        self._latency.record((time.perf_counter() - start) * 1000, {"result": result})
+        return entry
+
+    def put(self, name: str, profile: dict | None) -> CachedCharacter:
+        ttl = self.ttl if profile is not None else self.negative_ttl
+        entry = CachedCharacter(profile, time.time_ns(), time.time() + ttl)
+        self._disk.set(
+            ("character", name), {"profile": profile, "version": entry.version}, expire=ttl
+        )
+        self._disk.set(("version", name), entry.version, expire=ttl)
+        self._remember(name, entry)
+        return entry
+
+    def invalidate(self, name: str) -> None:
+        with self._lock:
+            self._memory.pop(name, None)
+        self._disk.delete(("character", name))
+        self._disk.delete(("version", name))
+
+    async def load(
+        self, manager: AsyncSupabaseManager, names: list[str]
+    ) -> dict[str, dict | None]:
+        """Profiles for names, cache misses are fetched together in one request."""
+        profiles, missing = {}, []
+        for name in dict.fromkeys(names):
+            entry = self.get(name)
+            if entry is None:
+                missing.append(name)
+            else:
+                profiles[name] = entry.profile
+        if missing:
+            rows = await entity_loader.load(manager, "character", missing)
+            for name, row in rows.items():
+                profiles[name] = self.put(name, row["profile"] if row else None).profile
+        return profiles
+
+    def _lookup(self, name: str) -> tuple[CachedCharacter | None, str]:
+        with self._lock:
+            entry = self._memory.get(name)
+        if entry is not None and entry.expires_at > time.time():
+            # another worker may have written a newer profile
+            if self._disk.get(("version", name)) == entry.version:
+                with self._lock:
+                    self._memory.move_to_end(name)
+                return entry, "memory_hit"
+
+        data, expire_time = self._disk.get(("character", name), expire_time=True)
+        if data is None:
+            with self._lock:
+                self._memory.pop(name, None)
+            return None, "miss"
+        entry = CachedCharacter(data["profile"], data["version"], expire_time or float("inf"))
+        self._remember(name, entry)
+        return entry, "disk_hit"
+
+    def _remember(self, name: str, entry: CachedCharacter) -> None:
+        with self._lock:
+            self._memory[name] = entry
+            self._memory.move_to_end(name)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+
+character_cache = CharacterCache(
+    directory=settings.character_cache_dir, ttl=settings.character_cache_ttl
+)
@@ -1,5 +1,10 @@
+import base64
+import json
+from collections.abc import AsyncIterator
 from datetime import datetime
 
+import httpx
+import logfire
 from pydantic_ai.exceptions import UnexpectedModelBehavior
 from pydantic_ai.messages import (
     ModelMessage,
@@ -9,54 +14,260 @@ from pydantic_ai.messages import (
     TextPart,
     UserPromptPart,
 )
+from pydantic_ai.result import StreamedRunResult
 
-from managers.supabase import SupabaseManager
-from models.chat import ChatMessage, Conversations
-from schemas.supabase import ConversationScehma
+from managers.conversation_cache import conversation_cache
+from managers.supabase import AsyncSupabaseManager
+from models.chat import ChatMessage, ChatMessagesPage, Conversations, ConversationsPage
+from schemas.supabase import ConversationMessageSchema, ConversationScehma
 
 
-def get_conversations(manager: SupabaseManager) -> list[Conversations]:
-    response = (
-        manager.supabase.table("conversation")
-        .select("id, title, updated_at")
-        .order("updated_at", desc=True)
-        .execute()
+class MessageConflict(Exception):
+    """Message rows kept colliding with different rows stored at the same seq."""
+
+    def __init__(self, conversation_ids: set[int]):
+        super().__init__(f"Conflicting message seq in conversations {sorted(conversation_ids)}")
+        self.conversation_ids = conversation_ids
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+async def get_conversations(
+    manager: AsyncSupabaseManager, limit: int = 20, cursor: str | None = None
+) -> ConversationsPage:
+    """Most recently updated conversations first, keyset-paginated on (updated_at, id)."""
+    params = {
+        "select": "id,title,updated_at",
+        "order": "updated_at.desc,id.desc",
+        "limit": limit + 1,
+    }
+    if cursor:
+        updated_at, conversation_id = decode_cursor(cursor)
+        params["or"] = (
+            f'(updated_at.lt."{updated_at}",'
+            f'and(updated_at.eq."{updated_at}",id.lt.{conversation_id:d}))'
+        )
+    rows = await manager.select("conversation", params)
+    conversations = [Conversations(**conversation) for conversation in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last = conversations[-1]
+        next_cursor = encode_cursor(last["updated_at"], last["id"])
+    return ConversationsPage(conversations=conversations, next_cursor=next_cursor)
+
+
+def encode_cursor(updated_at: str, conversation_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([updated_at, conversation_id]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[str, int]:
+    """Raises InvalidCursor for anything encode_cursor did not produce."""
+    try:
+        updated_at, conversation_id = json.loads(base64.urlsafe_b64decode(cursor))
+        # re-serialized so only a timestamp can reach the PostgREST filter
+        return datetime.fromisoformat(updated_at).isoformat(), int(conversation_id)
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor}") from e
+
+
+async def get_conversation_page(
+    manager: AsyncSupabaseManager,
+    conversation_id: int,
+    limit: int = 50,
+    before: int | None = None,
+) -> ChatMessagesPage:
+    """The last `limit` messages before seq `before`, tail first so the newest load fastest."""
+    user_id = await manager.get_user_id()
+    cached = conversation_cache.get(user_id, conversation_id) if user_id else None
+    if cached is not None:
+        end = len(cached) if before is None else min(before, len(cached))
+        start = max(end - limit, 0)
+        return to_chat_messages_page(cached[start:end], start)
+
+    params = {
+        "select": "seq,message",
+        "conversation_id": f"eq.{conversation_id}",
+        "order": "seq.desc",
+        "limit": limit,
+    }
+    if before is not None:
+        params["seq"] = f"lt.{before:d}"
+    rows = await manager.select("conversation_message", params)
+    if not rows and before is None:
+        # not migrated yet, or empty
+        messages = await migrate_conversation(manager, conversation_id)
+        start = max(len(messages) - limit, 0)
+        return to_chat_messages_page(messages[start:], start)
+
+    rows.reverse()
+    messages = ModelMessagesTypeAdapter.validate_python([row["message"] for row in rows])
+    return to_chat_messages_page(messages, rows[0]["seq"] if rows else 0)
+
+
+def to_chat_messages_page(messages: list[ModelMessage], first_seq: int) -> ChatMessagesPage:
+    return ChatMessagesPage(
+        messages=[to_chat_message(m) for m in messages],
+        next_cursor=first_seq if first_seq > 0 else None,
     )
-    return [Conversations(**conversation) for conversation in response.data]
 
 
-def get_conversation(manager: SupabaseManager, conversation_id: int) -> list[ModelMessage]:
-    response = (
-        manager.supabase.table("conversation")
-        .select("messages")
-        .eq("id", conversation_id)
-        .execute()
+async def get_conversation(
+    manager: AsyncSupabaseManager, conversation_id: int
+) -> list[ModelMessage]:
+    # cache entries are per user, a hit needs no RLS check
+    user_id = await manager.get_user_id()
+    cached = conversation_cache.get(user_id, conversation_id) if user_id else None
+    if cached is not None:
+        return cached
+
+    response = await manager.select(
+        "conversation",
+        {
+            "select": "updated_at,conversation_message(seq,message)",
+            "id": f"eq.{conversation_id}",
+            "conversation_message.order": "seq",
+        },
     )
-    if not response.data:
+    if not response:
         return []
-    conversation = response.data[0]["messages"]
-    messages: list[ModelMessage] = []
+    conversation = response[0]
+    rows = conversation["conversation_message"]
+    if rows:
+        messages = ModelMessagesTypeAdapter.validate_python([row["message"] for row in rows])
+    else:
+        messages = await migrate_conversation(manager, conversation_id)
+    if user_id:
+        conversation_cache.put(user_id, conversation_id, messages, conversation["updated_at"])
+    return messages
+
 
-    messages.extend(ModelMessagesTypeAdapter.validate_json(conversation))
+async def migrate_conversation(
+    manager: AsyncSupabaseManager, conversation_id: int
+) -> list[ModelMessage]:
+    """Move a conversation still stored in the legacy messages blob to conversation_message."""
+    response = await manager.select(
+        "conversation", {"select": "messages", "id": f"eq.{conversation_id}"}
+    )
+    if not response or not response[0]["messages"]:
+        return []
+    messages = ModelMessagesTypeAdapter.validate_json(response[0]["messages"])
+    await insert_messages(manager, conversation_id, messages, start_seq=0)
     return messages
 
 
-def upsert_conversation(
-    manager: SupabaseManager,
+async def insert_messages(
+    manager: AsyncSupabaseManager,
+    conversation_id: int,
+    messages: list[ModelMessage],
+    start_seq: int,
+) -> None:
+    rows = to_message_rows(conversation_id, messages, start_seq)
+    if rows:
+        await append_message_rows(manager, rows)
+
+
+async def append_message_rows(
+    manager: AsyncSupabaseManager, rows: list[dict], attempts: int = 3
+) -> set[int]:
+    """Insert message rows, returns the conversations whose rows were renumbered.
+
+    The insert is one statement, so it lands completely or not at all. On a seq
+    conflict the stored rows are compared with ours: identical rows are repeats
+    of a retried write and skipped. A conversation with different rows at our
+    seqs was appended to from a stale history (e.g. another worker's cache), so
+    its rows are rebased after the stored tail and inserted again. Raises
+    MessageConflict if that keeps colliding after `attempts` inserts.
+    """
+    try:
+        await manager.insert("conversation_message", rows)
+        return set()
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code != 409:
+            raise
+
+    seqs: dict[int, list[int]] = {}
+    for row in rows:
+        seqs.setdefault(row["conversation_id"], []).append(row["seq"])
+    filters = ",".join(
+        f"and(conversation_id.eq.{conversation_id:d},seq.in.({','.join(map(str, ids))}))"
+        for conversation_id, ids in seqs.items()
+    )
+    stored = {
+        (row["conversation_id"], row["seq"]): row["message"]
+        for row in await manager.select(
+            "conversation_message",
+            {"select": "conversation_id,seq,message", "or": f"({filters})"},
+        )
+    }
+    conflicts = {
+        row["conversation_id"]
+        for row in rows
+        if stored.get((row["conversation_id"], row["seq"]), row["message"]) != row["message"]
+    }
+    clean = [row for row in rows if row["conversation_id"] not in conflicts]
+    if clean:
+        await manager.upsert(
+            "conversation_message",
+            clean,
+            on_conflict="conversation_id,seq",
+            ignore_duplicates=True,
+        )
+    if not conflicts:
+        return set()
+    if attempts <= 1:
+        raise MessageConflict(conflicts)
+
+    rebased = []
+    for conversation_id in conflicts:
+        [tail] = await manager.select(
+            "conversation_message",
+            {
+                "select": "seq",
+                "conversation_id": f"eq.{conversation_id:d}",
+                "order": "seq.desc",
+                "limit": 1,
+            },
+        )
+        pending = [
+            row
+            for row in rows
+            if row["conversation_id"] == conversation_id
+            and stored.get((conversation_id, row["seq"])) != row["message"]
+        ]
+        rebased += [{**row, "seq": tail["seq"] + 1 + i} for i, row in enumerate(pending)]
+    logfire.warn("rebasing message rows of conversations {ids}", ids=sorted(conflicts))
+    await append_message_rows(manager, rebased, attempts - 1)
+    return conflicts
+
+
+def to_message_rows(
+    conversation_id: int, messages: list[ModelMessage], start_seq: int
+) -> list[dict]:
+    return [
+        ConversationMessageSchema(
+            conversation_id=conversation_id, seq=start_seq + i, message=message
+        ).model_dump()
+        for i, message in enumerate(ModelMessagesTypeAdapter.dump_python(messages, mode="json"))
+    ]
+
+
+async def upsert_conversation(
+    manager: AsyncSupabaseManager,
     user_id: str,
     title: str,
-    conversation_history: str,
     conversation_id: int | None = None,
-) -> None:
-
+) -> dict:
+    """Create or touch the conversation row and return it."""
     conversation = ConversationScehma(
         id=conversation_id,
         user_id=user_id,
-        messages=conversation_history,
         updated_at=datetime.now().isoformat(),
         title=title,
     ).model_dump(exclude_none=True)
-    manager.supabase.table("conversation").upsert(conversation).execute()
+    [row] = await manager.upsert("conversation", conversation)
+    return row
 
 
 def to_chat_message(m: ModelMessage) -> ChatMessage:
@@ -73,3 +284,16 @@ def to_chat_message(m: ModelMessage) -> ChatMessage:
                 role="model", timestamp=m.timestamp.isoformat(), content=first_part.content
             )
     raise UnexpectedModelBehavior(f"Unexpected message type for chat app: {m}")
+
+
+async def stream_deltas(result: StreamedRunResult) -> AsyncIterator[str]:
+    """Text deltas of a streamed run.
+
+    stream_text(delta=True) never marks the run complete, so new_messages() would
+    miss the reply. Slicing the cumulative text keeps the reply in the history.
+    """
+    sent = 0
+    async for text in result.stream_text(debounce_by=None):
+        if len(text) > sent:
+            yield text[sent:]
+            sent = len(text)
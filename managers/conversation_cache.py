@@ -0,0 +1,129 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+
+import logfire
+from diskcache import Cache
+from pydantic_ai.messages import ModelMessage, ModelMessagesTypeAdapter
+
+from config import settings
+
+
+@dataclass
+class CachedConversation:
+    messages: list[ModelMessage]
+    version: str
+    size: int
+
+
+class ConversationCache:
+    """Parsed message history per conversation, so active chats skip the DB read and validation.
+
+    Entries are keyed by (user_id, conversation_id) and only created from a read
+    made with that user's token or for a conversation the user just created, so
+    a hit never serves a conversation row-level security would hide. Entries
+    carry the conversation's updated_at as version and are evicted LRU by
+    approximate size (serialized JSON bytes). With shared_directory set, versions
+    are also published to a diskcache shared by all workers on the host: a worker
+    whose entry is older than the published version treats it as a miss.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, shared_directory: str | None = None):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: OrderedDict[tuple[str, int], CachedConversation] = OrderedDict()
+        self._lock = Lock()
+        self._versions = Cache(shared_directory) if shared_directory else None
+
+    def get(self, user_id: str, conversation_id: int) -> list[ModelMessage] | None:
+        conversation_id = int(conversation_id)
+        key = (user_id, conversation_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and self._versions is not None:
+                if self._versions.get(conversation_id) != entry.version:
+                    self._remove(key)
+                    entry = None
+            if entry is None:
+                logfire.debug("conversation cache miss: {id}", id=conversation_id)
+                return None
+            self._entries.move_to_end(key)
+            # callers extend the history they get back
+            return list(entry.messages)
+
+    def put(
+        self, user_id: str, conversation_id: int, messages: list[ModelMessage], version: str
+    ) -> None:
+        """Cache a history read from the DB with user_id's token."""
+        conversation_id = int(conversation_id)
+        key = (user_id, conversation_id)
+        size = len(ModelMessagesTypeAdapter.dump_json(messages))
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = CachedConversation(list(messages), version, size)
+            self.size += size
+            self._evict()
+        self._publish(conversation_id, version)
+
+    def append(
+        self,
+        user_id: str,
+        conversation_id: int,
+        messages: list[ModelMessage],
+        start_seq: int,
+        version: str,
+        created: bool = False,
+    ) -> None:
+        """Extend a cached history in place after a turn was persisted.
+
+        Entries that do not end exactly at start_seq are out of sync and dropped.
+        Without an entry, one is only started for a conversation user_id just
+        created, any other conversation must first be read with the user's token.
+        """
+        conversation_id = int(conversation_id)
+        key = (user_id, conversation_id)
+        size = len(ModelMessagesTypeAdapter.dump_json(messages))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and len(entry.messages) == start_seq:
+                entry.messages.extend(messages)
+                entry.version = version
+                entry.size += size
+                self.size += size
+                self._entries.move_to_end(key)
+                self._evict()
+            elif entry is not None:
+                self._remove(key)
+            elif created and start_seq == 0:
+                self._entries[key] = CachedConversation(list(messages), version, size)
+                self.size += size
+                self._evict()
+        self._publish(conversation_id, version)
+
+    def invalidate(self, user_id: str, conversation_id: int) -> None:
+        conversation_id = int(conversation_id)
+        with self._lock:
+            self._remove((user_id, conversation_id))
+        if self._versions is not None:
+            self._versions.delete(conversation_id)
+
+    def _publish(self, conversation_id: int, version: str) -> None:
+        if self._versions is not None:
+            self._versions.set(conversation_id, version)
+
+    def _remove(self, key: tuple[str, int]) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def _evict(self) -> None:
+        # always keep the most recent entry, even if it alone exceeds max_bytes
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            self.size -= entry.size
+
+
+conversation_cache = ConversationCache(
+    max_bytes=settings.conversation_cache_max_bytes,
+    shared_directory=settings.conversation_cache_shared_dir,
+)
@@ -0,0 +1,157 @@
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from dataclasses import dataclass, field
+
+import logfire
+import pydantic_core
+from pydantic_ai import Agent
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelRequest,
+    ModelResponse,
+    SystemPromptPart,
+    UserPromptPart,
+)
+
+from agents.registry import agent_registry
+from agents.scheduler import estimate_tokens, llm_scheduler
+
+Tokenizer = Callable[[str], int]
+
+
+summary_agent = Agent(
+    agent_registry.model("openai:gpt-4o-mini"),
+    name="history_summarizer",
+    system_prompt="""You maintain a running summary of a conversation.
+    Merge the previous summary with the new transcript into one concise summary.
+    Keep names, facts, decisions, open questions and anything either side asked to remember.
+    Answer with the summary only.
+    """,
+)
+
+
+@dataclass
+class RollingSummary:
+    # messages[:folded_upto] are represented by text
+    folded_upto: int
+    text: str
+
+
+@dataclass
+class HistoryWindow:
+    """Token-budgeted view of a message history for agent.run.
+
+    While the history fits in budget_tokens it is passed through unchanged. Once
+    it does not, older turns are folded into a rolling summary and only the
+    recent turns are kept, trimmed to low_watermark * budget_tokens so that the
+    summary is recomputed every few turns rather than on each one. Summaries
+    are cached per conversation key and only extended with newly folded turns.
+    """
+
+    budget_tokens: int = 8000
+    low_watermark: float = 0.5
+    tokenizer: Tokenizer = estimate_tokens
+    summarizer: Agent = field(default_factory=lambda: summary_agent)
+    max_conversations: int = 1024
+    _summaries: OrderedDict[Hashable, RollingSummary] = field(
+        default_factory=OrderedDict, init=False, repr=False
+    )
+
+    async def apply(
+        self, key: Hashable | None, messages: list[ModelMessage]
+    ) -> list[ModelMessage]:
+        """Return the history to send, key identifies the conversation (None: no caching)."""
+        tokens = [self.message_tokens(m) for m in messages]
+        if sum(tokens) <= self.budget_tokens:
+            return messages
+
+        summary = self._summaries.get(key) if key is not None else None
+        if summary is not None and summary.folded_upto > len(messages):
+            summary = None
+        folded_upto = summary.folded_upto if summary else 0
+
+        summary_tokens = self.tokenizer(summary.text) if summary else 0
+        if not summary or sum(tokens[folded_upto:]) + summary_tokens > self.budget_tokens:
+            start = self._window_start(messages, tokens, folded_upto)
+            if start > folded_upto:
+                with logfire.span("summarize {count} messages", count=start - folded_upto):
+                    text = await self._summarize(
+                        summary.text if summary else "", messages[folded_upto:start]
+                    )
+                summary = RollingSummary(folded_upto=start, text=text)
+                if key is not None:
+                    self._remember(key, summary)
+
+        if not summary or summary.folded_upto == 0:
+            return messages
+        return self._compose(messages, summary)
+
+    def message_tokens(self, message: ModelMessage) -> int:
+        total = 0
+        for part in message.parts:
+            content = getattr(part, "content", None)
+            if not isinstance(content, str):
+                content = pydantic_core.to_json(part).decode()
+            total += self.tokenizer(content)
+        return total
+
+    def _window_start(self, messages: list[ModelMessage], tokens: list[int], after: int) -> int:
+        """First turn boundary after `after` whose tail fits the low watermark, else the last."""
+        target = self.budget_tokens * self.low_watermark
+        boundaries = [
+            i for i in range(max(after, 1), len(messages)) if is_turn_start(messages[i])
+        ]
+        if not boundaries:
+            return after
+        for boundary in boundaries:
+            if sum(tokens[boundary:]) <= target:
+                return boundary
+        return boundaries[-1]
+
+    async def _summarize(self, previous: str, messages: list[ModelMessage]) -> str:
+        transcript = "\n".join(render_message(m) for m in messages)
+        result = await llm_scheduler.run(
+            self.summarizer,
+            f"# Previous summary\n{previous or '(none)'}\n\n# New transcript\n{transcript}",
+        )
+        return result.data
+
+    def _compose(
+        self, messages: list[ModelMessage], summary: RollingSummary
+    ) -> list[ModelMessage]:
+        system_parts = [p for p in messages[0].parts if isinstance(p, SystemPromptPart)]
+        summary_part = SystemPromptPart(
+            content=f"Summary of the earlier conversation:\n{summary.text}"
+        )
+        head = messages[summary.folded_upto]
+        assert isinstance(head, ModelRequest)
+        return [
+            ModelRequest(parts=[*system_parts, summary_part, *head.parts]),
+            *messages[summary.folded_upto + 1 :],
+        ]
+
+    def _remember(self, key: Hashable, summary: RollingSummary) -> None:
+        self._summaries[key] = summary
+        self._summaries.move_to_end(key)
+        while len(self._summaries) > self.max_conversations:
+            self._summaries.popitem(last=False)
+
+
+def is_turn_start(message: ModelMessage) -> bool:
+    """A request carrying a user prompt, cutting there never splits a tool call from its return."""
+    return isinstance(message, ModelRequest) and any(
+        isinstance(part, UserPromptPart) for part in message.parts
+    )
+
+
+def render_message(message: ModelMessage) -> str:
+    role = "assistant" if isinstance(message, ModelResponse) else "user"
+    lines = []
+    for part in message.parts:
+        if isinstance(part, SystemPromptPart):
+            continue
+        content = getattr(part, "content", None)
+        if not isinstance(content, str):
+            content = pydantic_core.to_json(part).decode()
+        lines.append(f"{role} ({part.part_kind}): {content}")
+    return "\n".join(lines)
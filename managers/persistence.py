@@ -0,0 +1,258 @@
+import asyncio
+from collections import defaultdict
+from collections.abc import Hashable
+from dataclasses import dataclass
+from datetime import datetime
+
+import logfire
+from pydantic_ai.messages import ModelMessage
+
+from managers.chat import (
+    MessageConflict,
+    append_message_rows,
+    to_message_rows,
+    upsert_conversation,
+)
+from managers.character_cache import character_cache
+from managers.conversation_cache import conversation_cache
+from managers.supabase import AsyncSupabaseManager
+from schemas.supabase import ConversationScehma
+
+
+@dataclass
+class PendingConversation:
+    manager: AsyncSupabaseManager
+    user_id: str
+    title: str
+    conversation_id: int
+    start_seq: int
+    messages: list[ModelMessage]
+    updated_at: str
+
+
+@dataclass
+class PendingEntity:
+    manager: AsyncSupabaseManager
+    table: str
+    name: str
+    profile: dict
+
+
+Pending = PendingConversation | PendingEntity
+_FLUSH = object()
+
+
+class WriteBehindWriter:
+    """Takes conversation and entity writes off the request path.
+
+    Handlers enqueue writes and return immediately. A background task coalesces
+    them (consecutive turns of one conversation become one append, repeated
+    saves of an entity keep the last profile) and flushes every flush_interval
+    seconds or once max_pending keys are waiting. Each flush issues one bulk
+    request per table and auth context. stop() drains everything still queued.
+    """
+
+    def __init__(
+        self, flush_interval: float = 1.0, max_pending: int = 200, max_retries: int = 3
+    ):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self._queue: asyncio.Queue[Pending | object | None] = asyncio.Queue()
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="write_behind")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    async def flush(self) -> None:
+        """Ask the writer to flush now, without waiting for the writes to land."""
+        await self._queue.put(_FLUSH)
+
+    def enqueue_conversation(
+        self,
+        manager: AsyncSupabaseManager,
+        user_id: str,
+        title: str,
+        conversation_id: int,
+        messages: list[ModelMessage],
+        start_seq: int,
+    ) -> str:
+        """Queue a turn's messages, returns the updated_at the conversation will get."""
+        updated_at = datetime.now().isoformat()
+        self._put(
+            PendingConversation(
+                manager, user_id, title, int(conversation_id), start_seq, messages, updated_at
+            )
+        )
+        return updated_at
+
+    def enqueue_entity(
+        self, manager: AsyncSupabaseManager, table: str, name: str, profile: dict
+    ) -> None:
+        self._put(PendingEntity(manager, table, name, profile))
+
+    def _put(self, item: Pending) -> None:
+        self.start()
+        self._queue.put_nowait(item)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        pending: dict[Hashable, Pending] = {}
+        deadline = 0.0
+        while True:
+            timeout = max(deadline - loop.time(), 0) if pending else None
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout)
+            except TimeoutError:
+                item = _FLUSH
+            if item is None:
+                await self._flush(pending)
+                return
+            if item is not _FLUSH:
+                if not pending:
+                    deadline = loop.time() + self.flush_interval
+                coalesce(pending, item)
+            if item is _FLUSH or len(pending) >= self.max_pending:
+                await self._flush(pending)
+                pending = {}
+
+    async def _flush(self, pending: dict[Hashable, Pending]) -> None:
+        by_manager: dict[int, list[Pending]] = defaultdict(list)
+        for item in pending.values():
+            by_manager[id(item.manager)].append(item)
+        for items in by_manager.values():
+            with logfire.span("write-behind flush of {count} writes", count=len(items)):
+                for attempt in range(1, self.max_retries + 1):
+                    try:
+                        await write_batch(items)
+                        break
+                    except MessageConflict as e:
+                        # rebasing kept colliding, retrying the same rows cannot fix it
+                        logfire.error(
+                            "write-behind dropped conflicting turns: {error}", error=str(e)
+                        )
+                        for item in items:
+                            if (
+                                isinstance(item, PendingConversation)
+                                and item.conversation_id in e.conversation_ids
+                            ):
+                                conversation_cache.invalidate(item.user_id, item.conversation_id)
+                        break
+                    except Exception:
+                        if attempt < self.max_retries:
+                            await asyncio.sleep(0.5 * 2**attempt)
+                            continue
+                        logfire.exception("write-behind flush failed, dropping writes")
+                        for item in items:
+                            if isinstance(item, PendingConversation):
+                                conversation_cache.invalidate(
+                                    item.user_id, item.conversation_id
+                                )
+                            elif item.table == "character":
+                                # written through on update, drop the profile that never landed
+                                character_cache.invalidate(item.name)
+
+
+def coalesce(pending: dict[Hashable, Pending], item: Pending) -> None:
+    if isinstance(item, PendingEntity):
+        pending[("entity", item.table, item.name)] = item
+        return
+
+    key = ("conversation", item.conversation_id)
+    current = pending.get(key)
+    if current is None:
+        pending[key] = item
+    elif current.start_seq + len(current.messages) == item.start_seq:
+        current.messages = [*current.messages, *item.messages]
+        current.title = item.title
+        current.updated_at = item.updated_at
+    else:
+        # not contiguous with what is queued, flush it as a separate append
+        pending[(*key, item.start_seq)] = item
+
+
+async def write_batch(items: list[Pending]) -> None:
+    """Write one manager's coalesced items, one request per table unless message seqs conflict."""
+    manager = items[0].manager
+    conflict = None
+    conversations = [item for item in items if isinstance(item, PendingConversation)]
+    if conversations:
+        latest = {c.conversation_id: c for c in conversations}
+        await manager.upsert(
+            "conversation",
+            [
+                ConversationScehma(
+                    id=c.conversation_id,
+                    user_id=c.user_id,
+                    title=c.title,
+                    updated_at=c.updated_at,
+                ).model_dump(exclude_none=True)
+                for c in latest.values()
+            ],
+        )
+        rows = [
+            row
+            for c in conversations
+            for row in to_message_rows(c.conversation_id, c.messages, c.start_seq)
+        ]
+        if rows:
+            # a retried flush may repeat rows that already landed
+            try:
+                rebased = await append_message_rows(manager, rows)
+            except MessageConflict as e:
+                # still write the entities below
+                conflict = e
+            else:
+                # the stored order differs from what the cached histories hold
+                for c in conversations:
+                    if c.conversation_id in rebased:
+                        conversation_cache.invalidate(c.user_id, c.conversation_id)
+
+    entities: dict[str, list[dict]] = defaultdict(list)
+    for item in items:
+        if isinstance(item, PendingEntity):
+            entities[item.table].append({"name": item.name, "profile": item.profile})
+    for table, rows in entities.items():
+        await manager.upsert(table, rows)
+    if conflict is not None:
+        raise conflict
+
+
+async def persist_turn(
+    manager: AsyncSupabaseManager,
+    user_id: str,
+    title: str,
+    new_messages: list[ModelMessage],
+    start_seq: int,
+    conversation_id: int | None = None,
+    created: bool = False,
+) -> int:
+    """Record a turn without waiting for the DB, returns the conversation id.
+
+    Only a brand-new conversation costs a round trip, to obtain its id.
+    start_seq: number of messages already stored, i.e. len(message_history) before the run.
+    created: the caller created conversation_id itself (upsert_conversation) for this turn.
+    """
+    created = created or not conversation_id
+    if not conversation_id:
+        conversation = await upsert_conversation(manager, user_id, title)
+        conversation_id = conversation["id"]
+    updated_at = write_behind.enqueue_conversation(
+        manager, user_id, title, conversation_id, new_messages, start_seq
+    )
+    # only extends entries user_id already read (RLS-checked) or the conversation it just created
+    conversation_cache.append(
+        user_id, conversation_id, new_messages, start_seq, updated_at, created=created
+    )
+    return conversation_id
+
+
+write_behind = WriteBehindWriter()
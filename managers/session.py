@@ -0,0 +1,124 @@
+import hashlib
+import sys
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+
+import logfire
+from diskcache import Cache
+
+from config import settings
+from managers.supabase import AsyncSupabaseManager
+
+
+@dataclass
+class Session:
+    user_id: str
+    # unix time the access token expires at
+    expires_at: float
+
+    def expired(self) -> bool:
+        return self.expires_at <= time.time()
+
+
+def session_key(access_token: str) -> str:
+    # never keep raw tokens as keys, they would be readable from the shared store
+    return hashlib.sha256(access_token.encode()).hexdigest()
+
+
+class MemorySessionStore:
+    """In-process sessions keyed by access token, for a single worker.
+
+    Entries expire with their token and are evicted LRU once max_sessions or
+    max_bytes (approximate, key plus entry) is exceeded.
+    """
+
+    def __init__(self, max_sessions: int = 10_000, max_bytes: int = 16 * 1024 * 1024):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._sessions: OrderedDict[str, tuple[Session, int]] = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, access_token: str) -> Session | None:
+        key = session_key(access_token)
+        with self._lock:
+            entry = self._sessions.get(key)
+            if entry is None:
+                return None
+            if entry[0].expired():
+                self._remove(key)
+                return None
+            self._sessions.move_to_end(key)
+            return entry[0]
+
+    def put(self, access_token: str, session: Session) -> None:
+        key = session_key(access_token)
+        size = sys.getsizeof(key) + sys.getsizeof(session) + sys.getsizeof(session.user_id)
+        with self._lock:
+            self._remove(key)
+            self._sessions[key] = (session, size)
+            self.size += size
+            while len(self._sessions) > 1 and (
+                len(self._sessions) > self.max_sessions or self.size > self.max_bytes
+            ):
+                _, (_, evicted) = self._sessions.popitem(last=False)
+                self.size -= evicted
+
+    def delete(self, access_token: str) -> None:
+        with self._lock:
+            self._remove(session_key(access_token))
+
+    def _remove(self, key: str) -> None:
+        entry = self._sessions.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+
+class DiskSessionStore:
+    """Sessions in a diskcache (sqlite) directory shared by all workers on the host.
+
+    diskcache expires entries with their token and evicts least recently used
+    ones once the directory grows past size_limit bytes.
+    """
+
+    def __init__(self, directory: str, size_limit: int = 64 * 1024 * 1024):
+        self._cache = Cache(
+            directory, size_limit=size_limit, eviction_policy="least-recently-used"
+        )
+
+    def get(self, access_token: str) -> Session | None:
+        session = self._cache.get(session_key(access_token))
+        if session is None or session.expired():
+            return None
+        return session
+
+    def put(self, access_token: str, session: Session) -> None:
+        self._cache.set(
+            session_key(access_token), session, expire=max(session.expires_at - time.time(), 1)
+        )
+
+    def delete(self, access_token: str) -> None:
+        self._cache.delete(session_key(access_token))
+
+
+SessionStore = MemorySessionStore | DiskSessionStore
+
+
+def open_session(store: SessionStore, access_token: str) -> AsyncSupabaseManager | None:
+    """Manager for a signed-in token, None if it was never stored, signed out or expired."""
+    session = store.get(access_token)
+    if session is None:
+        logfire.debug("session miss")
+        return None
+    return AsyncSupabaseManager(access_token)
+
+
+def create_session_store() -> SessionStore:
+    if settings.session_store_dir:
+        return DiskSessionStore(settings.session_store_dir)
+    return MemorySessionStore(max_sessions=settings.session_store_max_sessions)
+
+
+session_store = create_session_store()
@@ -1,7 +1,13 @@
+import asyncio
+import time
+from typing import ClassVar
+
+import httpx
 from fastapi import HTTPException
 from supabase import Client, create_client
 
 from config import settings
+from managers.auth import token_verifier
 
 
 class SupabaseManager:
@@ -58,3 +64,208 @@ class SupabaseManager:
     def save_entity(self, table: str, name: str, profile: dict):
         character = {"name": name, "profile": profile}
         self.supabase.from_(table).upsert(character).execute()
+
+
+class AsyncSupabaseManager:
+    """Async counterpart of SupabaseManager for request handlers.
+
+    Talks to the Supabase REST (PostgREST) and auth (GoTrue) endpoints through a
+    single pooled httpx.AsyncClient shared by every manager. A manager is only an
+    access token sent as a per-request Authorization header, so creating one per
+    user or request costs nothing and connections are reused across users.
+    """
+
+    _http: ClassVar[httpx.AsyncClient | None] = None
+
+    def __init__(self, access_token: str | None = None):
+        self.access_token = access_token
+        # only known for managers that signed in or refreshed themselves
+        self.refresh_token: str | None = None
+        self.expires_at: float | None = None
+
+    @classmethod
+    def http(cls) -> httpx.AsyncClient:
+        if cls._http is None or cls._http.is_closed:
+            cls._http = httpx.AsyncClient(
+                base_url=settings.supabase_url,
+                headers={"apikey": settings.supabase_anon_key},
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+                timeout=httpx.Timeout(10.0),
+            )
+        return cls._http
+
+    @classmethod
+    async def aclose(cls) -> None:
+        if cls._http is not None:
+            await cls._http.aclose()
+            cls._http = None
+
+    async def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        headers = {
+            "Authorization": f"Bearer {self.access_token or settings.supabase_anon_key}",
+            **kwargs.pop("headers", {}),
+        }
+        response = await self.http().request(method, path, headers=headers, **kwargs)
+        response.raise_for_status()
+        return response
+
+    async def _auth(self, method: str, path: str, **kwargs) -> httpx.Response:
+        try:
+            return await self._request(method, f"/auth/v1/{path}", **kwargs)
+        except httpx.HTTPStatusError as e:
+            raise HTTPException(status_code=401, detail=e.response.text)
+
+    async def _token(self, grant_type: str, payload: dict) -> dict:
+        response = await self._auth(
+            "POST", "token", params={"grant_type": grant_type}, json=payload
+        )
+        session = response.json()
+        tokens = {
+            "user_id": session["user"]["id"],
+            "access_token": session["access_token"],
+            "refresh_token": session["refresh_token"],
+            "expires_at": session.get("expires_at") or time.time() + session["expires_in"],
+        }
+        self.access_token = tokens["access_token"]
+        self.refresh_token = tokens["refresh_token"]
+        self.expires_at = tokens["expires_at"]
+        return tokens
+
+    async def sign_in_with_password(self, email: str, password: str) -> dict:
+        return await self._token("password", {"email": email, "password": password})
+
+    async def refresh_access_token(self, refresh_token: str) -> dict:
+        return await self._token("refresh_token", {"refresh_token": refresh_token})
+
+    def expires_within(self, seconds: float) -> bool:
+        return self.expires_at is not None and self.expires_at - time.time() < seconds
+
+    async def sign_out(self) -> None:
+        await self._auth("POST", "logout")
+        if self.access_token:
+            token_verifier.forget(self.access_token)
+
+    async def assert_session(self, access_token: str) -> bool:
+        await token_verifier.verify(access_token)
+        self.access_token = access_token
+        return True
+
+    async def get_user_id(self) -> str | None:
+        """Read from the verified token claims, no auth server round trip."""
+        if not self.access_token:
+            return None
+        return await token_verifier.user_id(self.access_token)
+
+    async def select(self, table: str, params: dict) -> list[dict]:
+        """GET rows with raw PostgREST query params, e.g. {"select": "*", "id": "eq.1"}."""
+        response = await self._request("GET", f"/rest/v1/{table}", params=params)
+        return response.json()
+
+    async def insert(self, table: str, rows: dict | list[dict]) -> list[dict]:
+        response = await self._request(
+            "POST",
+            f"/rest/v1/{table}",
+            json=rows,
+            headers={"Prefer": "return=representation"},
+        )
+        return response.json()
+
+    async def upsert(
+        self,
+        table: str,
+        rows: dict | list[dict],
+        on_conflict: str | None = None,
+        ignore_duplicates: bool = False,
+    ) -> list[dict]:
+        resolution = "ignore-duplicates" if ignore_duplicates else "merge-duplicates"
+        response = await self._request(
+            "POST",
+            f"/rest/v1/{table}",
+            json=rows,
+            params={"on_conflict": on_conflict} if on_conflict else None,
+            headers={"Prefer": f"resolution={resolution},return=representation"},
+        )
+        return response.json()
+
+    async def get_entity(self, table: str, name: str) -> dict | None:
+        rows = await self.select(table, {"select": "name,profile", "name": f"eq.{name}"})
+        return rows[0] if rows else None
+
+    async def get_entities(self, table: str, names: list[str]) -> dict[str, dict]:
+        """Rows for all names in one `in` filtered request, keyed by name."""
+        if not names:
+            return {}
+        values = ",".join(quote(name) for name in names)
+        rows = await self.select(table, {"select": "name,profile", "name": f"in.({values})"})
+        return {row["name"]: row for row in rows}
+
+    async def save_entity(self, table: str, name: str, profile: dict):
+        await self.upsert(table, {"name": name, "profile": profile})
+
+
+def quote(value: str) -> str:
+    """Quote a value for a PostgREST `in` list, so commas and parentheses survive."""
+    escaped = value.replace("\\", "\\\\").replace('"', '\\"')
+    return f'"{escaped}"'
+
+
+class EntityLoader:
+    """Batches and coalesces entity lookups across concurrent agent runs.
+
+    Names requested during the same event loop iteration are fetched with one
+    get_entities call per auth context and table, and a name that is already
+    being fetched joins that request instead of issuing another one.
+    """
+
+    def __init__(self):
+        self._inflight: dict[tuple[str | None, str, str], asyncio.Future] = {}
+        self._batches: dict[tuple[AsyncSupabaseManager, str], dict[str, asyncio.Future]] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    async def load(
+        self, manager: AsyncSupabaseManager, table: str, names: list[str]
+    ) -> dict[str, dict | None]:
+        futures = {name: self._enqueue(manager, table, name) for name in dict.fromkeys(names)}
+        # shield: a cancelled run must not cancel a fetch other runs are waiting on
+        return {name: await asyncio.shield(future) for name, future in futures.items()}
+
+    async def load_one(self, manager: AsyncSupabaseManager, table: str, name: str) -> dict | None:
+        return (await self.load(manager, table, [name]))[name]
+
+    def _enqueue(self, manager: AsyncSupabaseManager, table: str, name: str) -> asyncio.Future:
+        key = (manager.access_token, table, name)
+        future = self._inflight.get(key)
+        if future is not None:
+            return future
+        loop = asyncio.get_running_loop()
+        future = self._inflight[key] = loop.create_future()
+        batch = self._batches.get((manager, table))
+        if batch is None:
+            batch = self._batches[(manager, table)] = {}
+            loop.call_soon(self._dispatch, manager, table)
+        batch[name] = future
+        return future
+
+    def _dispatch(self, manager: AsyncSupabaseManager, table: str) -> None:
+        batch = self._batches.pop((manager, table))
+        task = asyncio.create_task(self._fetch(manager, table, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _fetch(
+        self, manager: AsyncSupabaseManager, table: str, batch: dict[str, asyncio.Future]
+    ) -> None:
+        try:
+            rows = await manager.get_entities(table, list(batch))
+        except Exception as e:
+            for future in batch.values():
+                future.set_exception(e)
+        else:
+            for name, future in batch.items():
+                future.set_result(rows.get(name))
+        finally:
+            for name in batch:
+                self._inflight.pop((manager.access_token, table, name), None)
+
+
+entity_loader = EntityLoader()
@@ -11,3 +11,15 @@ class ChatMessage(TypedDict):
     role: Literal["user", "model"]
     timestamp: str
     content: str
+
+
+class ConversationsPage(TypedDict):
+    conversations: list[Conversations]
+    # pass as cursor to get the next (older) page, None on the last page
+    next_cursor: str | None
+
+
+class ChatMessagesPage(TypedDict):
+    messages: list[ChatMessage]
+    # pass as before to get older messages, None when the history is exhausted
+    next_cursor: int | None
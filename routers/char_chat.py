@@ -1,9 +1,15 @@
+import json
+
+import logfire
 from fastapi import APIRouter, Depends
-from pydantic_ai.messages import ModelMessagesTypeAdapter
+from fastapi.responses import StreamingResponse
+from pydantic_ai.messages import ModelMessage
+from starlette.background import BackgroundTask
 
-from managers.char_chat import Deps, char_chat
-from managers.chat import get_conversation, upsert_conversation
-from managers.supabase import SupabaseManager
+from managers.char_chat import Deps, char_chat, char_chat_stream
+from managers.chat import get_conversation, stream_deltas, upsert_conversation
+from managers.persistence import persist_turn
+from managers.supabase import AsyncSupabaseManager
 from routers.supabase import get_supabase_dev
 
 char_router = APIRouter()
@@ -13,17 +19,72 @@ char_router = APIRouter()
 async def chat(
     text: str,
     conversation_id: int,
-    supabase: SupabaseManager = Depends(get_supabase_dev),
+    supabase: AsyncSupabaseManager = Depends(get_supabase_dev),
     ai_name: str = "",
     user_name: str = "",
 ):
-    message_history = get_conversation(supabase, conversation_id) if conversation_id else []
+    message_history = await get_conversation(supabase, conversation_id) if conversation_id else []
 
     # user_id, session_id for authorization
-    user_id = supabase.get_user_id()
+    user_id = await supabase.get_user_id()
     deps = Deps(supabase, ai_name=ai_name, user_name=user_name, conversation_id=conversation_id)
     result = await char_chat(text, message_history, deps)
-    message_history = result.all_messages()
-    message_history_json = ModelMessagesTypeAdapter.dump_json(message_history)
-    upsert_conversation(supabase, user_id, "Chat", message_history_json, conversation_id)
+    await persist_turn(
+        supabase, user_id, "Chat", result.new_messages(), len(message_history), conversation_id
+    )
     return result.data
+
+
+def sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@char_router.get("/char/chat/{conversation_id}/stream")
+async def chat_stream(
+    text: str,
+    conversation_id: int,
+    supabase: AsyncSupabaseManager = Depends(get_supabase_dev),
+    ai_name: str = "",
+    user_name: str = "",
+):
+    """/char/chat as server-sent events: `delta` events with text, then `done` or `error`."""
+    message_history = await get_conversation(supabase, conversation_id) if conversation_id else []
+    user_id = await supabase.get_user_id()
+    created = not conversation_id
+    if created:
+        # the done event must carry the id so the client can continue the conversation
+        conversation_id = (await upsert_conversation(supabase, user_id, "Chat"))["id"]
+    deps = Deps(supabase, ai_name=ai_name, user_name=user_name, conversation_id=conversation_id)
+    new_messages: list[ModelMessage] = []
+
+    async def events():
+        try:
+            async with char_chat_stream(text, message_history, deps) as result:
+                async for delta in stream_deltas(result):
+                    yield sse("delta", {"text": delta})
+                new_messages.extend(result.new_messages())
+        except Exception as e:
+            logfire.exception("char chat stream failed")
+            yield sse("error", {"error": str(e)})
+            return
+        yield sse("done", {"conversation_id": conversation_id})
+
+    async def persist():
+        # runs once the response has been sent, a disconnected client saves nothing
+        if new_messages:
+            await persist_turn(
+                supabase,
+                user_id,
+                "Chat",
+                new_messages,
+                len(message_history),
+                conversation_id,
+                created=created,
+            )
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(persist),
+    )
@@ -1,35 +1,188 @@
+import asyncio
 import json
+import time
 import uuid
 from dataclasses import dataclass, field
 
-from fastapi import APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect
+import logfire
+
+from fastapi import APIRouter, Depends, HTTPException, Query, WebSocket, WebSocketDisconnect
 from pydantic_ai import Agent
-from pydantic_ai.messages import ModelMessage, ModelMessagesTypeAdapter
+from pydantic_ai.messages import ModelMessage
 
+from agents.registry import agent_registry
+from agents.scheduler import llm_scheduler
 from managers.chat import (
+    InvalidCursor,
     get_conversation,
+    get_conversation_page,
     get_conversations,
-    to_chat_message,
-    upsert_conversation,
+    stream_deltas,
 )
-from managers.supabase import SupabaseManager
-from models.chat import ChatMessage, Conversations
+from managers.history import HistoryWindow
+from managers.persistence import persist_turn
+from managers.supabase import AsyncSupabaseManager
+from models.chat import ChatMessagesPage, ConversationsPage
 from routers.supabase import get_supabase, get_supabase_wb
 
 
 @dataclass
 class Deps:
-    supabase: SupabaseManager
+    supabase: AsyncSupabaseManager
     title: str = ""
     conversation_id: int | None = None
     message_history: list[ModelMessage] = field(default_factory=list)
 
 
-deps = Deps(supabase=SupabaseManager())
+deps = Deps(supabase=AsyncSupabaseManager())
 
-agent = Agent("gemini-1.5-pro", deps_type=Deps)
+agent = Agent(agent_registry.model("gemini-1.5-pro"), deps_type=Deps)
+history_window = HistoryWindow(budget_tokens=16000)
 chat_router = APIRouter()
 
+# persist the session every CHECKPOINT_TURNS turns or CHECKPOINT_SECONDS, whichever is first
+CHECKPOINT_TURNS = 4
+CHECKPOINT_SECONDS = 30.0
+# frames waiting for a slow client before the model stream is paused
+OUTBOX_SIZE = 64
+
+
+class ChatSession:
+    """One /ws/chat connection.
+
+    Replies are streamed as `delta` frames through a bounded outbox, so a slow
+    client pauses the model stream instead of buffering it. A new message or a
+    `cancel` frame cancels the run in flight, whose messages are discarded.
+    History is checkpointed every CHECKPOINT_TURNS turns, at least every
+    CHECKPOINT_SECONDS while there are unsaved turns (also when the session
+    is idle) and once more on disconnect.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        supabase: AsyncSupabaseManager,
+        agent: Agent,
+        user_id: str,
+        session_id: str,
+        conversation_id: int | None,
+        message_history: list[ModelMessage],
+    ):
+        self.websocket = websocket
+        self.supabase = supabase
+        self.agent = agent
+        self.user_id = user_id
+        self.session_id = session_id
+        self.conversation_id = conversation_id
+        self.message_history = message_history
+        self.persisted = len(message_history)
+        self.outbox: asyncio.Queue[dict] = asyncio.Queue(maxsize=OUTBOX_SIZE)
+        self._run: asyncio.Task | None = None
+        self._run_id = 0
+        self._turns = 0
+        self._checkpointed_at = time.monotonic()
+        self._checkpoint_lock = asyncio.Lock()
+
+    async def serve(self) -> None:
+        sender = asyncio.create_task(self._send_frames())
+        checkpointer = asyncio.create_task(self._checkpoint_periodically())
+        try:
+            while True:
+                request: dict = json.loads(await self.websocket.receive_text())
+                if (
+                    request.get("user_id", "") != self.user_id
+                    or request.get("session_id", "") != self.session_id
+                ):
+                    await self.outbox.put({"error": "Unauthorized"})
+                    continue
+                if request.get("type") == "cancel":
+                    await self.cancel(notify=True)
+                    continue
+                message = request.get("message", "")
+                if not message:
+                    continue
+                await self.cancel(notify=True)
+                self._run_id += 1
+                self._run = asyncio.create_task(self._respond(self._run_id, message))
+        finally:
+            await self.cancel(notify=False)
+            sender.cancel()
+            checkpointer.cancel()
+            await self.checkpoint()
+
+    async def cancel(self, notify: bool) -> None:
+        if self._run is None or self._run.done():
+            return
+        self._run.cancel()
+        await asyncio.wait([self._run])
+        # drop frames of the cancelled run the client has not received yet, keep the rest
+        # (e.g. the previous run's done frame) in order
+        pending = []
+        while not self.outbox.empty():
+            frame = self.outbox.get_nowait()
+            if frame.get("run_id") != self._run_id:
+                pending.append(frame)
+        for frame in pending:
+            self.outbox.put_nowait(frame)
+        if notify:
+            await self.outbox.put({"type": "cancelled", "run_id": self._run_id})
+
+    async def checkpoint(self) -> None:
+        async with self._checkpoint_lock:
+            upto = len(self.message_history)
+            if upto == self.persisted:
+                return
+            self.conversation_id = await persist_turn(
+                self.supabase,
+                self.user_id,
+                "Chat",
+                self.message_history[self.persisted : upto],
+                self.persisted,
+                self.conversation_id,
+            )
+            self.persisted = upto
+            self._turns = 0
+            self._checkpointed_at = time.monotonic()
+
+    async def _respond(self, run_id: int, message: str) -> None:
+        try:
+            history = await history_window.apply(
+                self.conversation_id or self.session_id, self.message_history
+            )
+            async with llm_scheduler.run_stream(
+                self.agent, message, message_history=history
+            ) as result:
+                async for delta in stream_deltas(result):
+                    await self.outbox.put({"type": "delta", "run_id": run_id, "text": delta})
+                new_messages = result.new_messages()
+        except Exception as e:
+            logfire.exception("chat run failed")
+            await self.outbox.put({"type": "error", "run_id": run_id, "error": str(e)})
+            return
+
+        self.message_history.extend(new_messages)
+        await self.outbox.put({"type": "done", "run_id": run_id})
+        self._turns += 1
+        if (
+            self._turns >= CHECKPOINT_TURNS
+            or time.monotonic() - self._checkpointed_at >= CHECKPOINT_SECONDS
+        ):
+            # shielded: a new message must not cancel a half-written checkpoint
+            await asyncio.shield(self.checkpoint())
+
+    async def _checkpoint_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(CHECKPOINT_SECONDS)
+            if len(self.message_history) > self.persisted:
+                try:
+                    await asyncio.shield(self.checkpoint())
+                except Exception:
+                    logfire.exception("chat checkpoint failed")
+
+    async def _send_frames(self) -> None:
+        while True:
+            await self.websocket.send_json(await self.outbox.get())
+
 
 @chat_router.websocket("/ws/chat")
 async def websocket_endpoint(websocket: WebSocket):
@@ -37,65 +190,58 @@ async def websocket_endpoint(websocket: WebSocket):
 
     # get authenticated supabase instance with access token for message_history
     try:
-        supabase: SupabaseManager = get_supabase_wb(
+        supabase: AsyncSupabaseManager = get_supabase_wb(
             access_token=websocket.headers.get("Authorization")
         )
         conversation_id = websocket.headers.get("conversation_id")
-        message_history = get_conversation(supabase, conversation_id) if conversation_id else []
+        message_history = (
+            await get_conversation(supabase, conversation_id) if conversation_id else []
+        )
     except Exception as e:
         await websocket.send_json({"error": str(e)})
         await websocket.close()
         return
 
     # user_id, session_id for authorization
-    user_id = supabase.get_user_id()
+    user_id = await supabase.get_user_id()
     session_id = str(uuid.uuid4())
     await websocket.send_json({"user_id": user_id, "session_id": session_id})
 
-    agent = Agent("gemini-1.5-flash")
+    # shared across connections, so sessions reuse the pooled provider connection
+    agent = agent_registry.get("gemini-1.5-flash")
+    session = ChatSession(
+        websocket, supabase, agent, user_id, session_id, conversation_id, message_history
+    )
 
-    # conversation loop
+    # conversation loop, checkpoints as it goes and saves the rest on disconnect
     try:
-        while True:
-            data = await websocket.receive_text()
-            request: dict = json.loads(data)
-            client_user_id = request.get("user_id", "")
-            client_session_id = request.get("session_id", "")
-            message = request.get("message", "")
-
-            if client_user_id != user_id or client_session_id != session_id:
-                await websocket.send_json({"error": "Unauthorized"})
-                continue
-            if not message:
-                continue
-
-            result = await agent.run(message, message_history=message_history)
-            message_history = result.all_messages()
-            await websocket.send_text(result.data)
+        await session.serve()
     except WebSocketDisconnect:
         print("Client disconnected")
 
-    # save conversation
-    finally:
-        if message_history:
-            message_history_json = ModelMessagesTypeAdapter.dump_json(message_history)
-            upsert_conversation(supabase, user_id, "Chat", message_history_json, conversation_id)
-
 
 @chat_router.get("/chat/conversations")
-def get_conversations_api(manager: SupabaseManager = Depends(get_supabase)) -> list[Conversations]:
+async def get_conversations_api(
+    limit: int = Query(20, ge=1, le=100),
+    cursor: str | None = None,
+    manager: AsyncSupabaseManager = Depends(get_supabase),
+) -> ConversationsPage:
     try:
-        return get_conversations(manager)
+        return await get_conversations(manager, limit, cursor)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch conversations: {str(e)}")
 
 
 @chat_router.get("/chat/conversation/{conversation_id}")
-def get_conversation_api(
-    conversation_id: int, manager: SupabaseManager = Depends(get_supabase)
-) -> list[ChatMessage]:
+async def get_conversation_api(
+    conversation_id: int,
+    limit: int = Query(50, ge=1, le=500),
+    before: int | None = None,
+    manager: AsyncSupabaseManager = Depends(get_supabase),
+) -> ChatMessagesPage:
     try:
-        conversation = get_conversation(manager, conversation_id)
-        return [to_chat_message(m) for m in conversation]
+        return await get_conversation_page(manager, conversation_id, limit, before)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch conversation: {str(e)}")
@@ -1,12 +1,17 @@
+import asyncio
+
 import logfire
 from fastapi import APIRouter, Cookie, Depends, Header, HTTPException
 from fastapi.responses import JSONResponse
 
 from config import settings
-from managers.supabase import SupabaseManager
+from managers.session import Session, open_session, session_store
+from managers.supabase import AsyncSupabaseManager
 
 supabase = None
-supabase_manager_cache = {}
+supabase_lock = asyncio.Lock()
+# refresh the dev session this long before its access token expires
+DEV_REFRESH_MARGIN = 5 * 60
 
 supabase_router = APIRouter()
 
@@ -18,38 +23,52 @@ def get_access_token(authorization: str = Header(...)) -> str:
     return authorization.split("Bearer ")[1]
 
 
-def get_supabase_dev() -> SupabaseManager:
+async def get_supabase_dev() -> AsyncSupabaseManager:
     email = settings.supabase_dev_email
     password = settings.supabase_dev_password
     global supabase
-    if supabase is None:
-        supabase = SupabaseManager()
-        supabase.sign_in_with_password(email, password)
+    if supabase is not None and not supabase.expires_within(DEV_REFRESH_MARGIN):
+        return supabase
+    async with supabase_lock:
+        if supabase is None:
+            manager = AsyncSupabaseManager()
+            await manager.sign_in_with_password(email, password)
+            supabase = manager
+        elif supabase.expires_within(DEV_REFRESH_MARGIN):
+            manager = AsyncSupabaseManager()
+            try:
+                await manager.refresh_access_token(supabase.refresh_token)
+            except HTTPException:
+                logfire.warn("dev session refresh failed, signing in again")
+                await manager.sign_in_with_password(email, password)
+            supabase = manager
     return supabase
 
 
-def get_supabase(access_token: str = Depends(get_access_token)) -> SupabaseManager:
-    if access_token in supabase_manager_cache:
-        return supabase_manager_cache[access_token]
-    else:
+def get_supabase(access_token: str = Depends(get_access_token)) -> AsyncSupabaseManager:
+    supabase = open_session(session_store, access_token)
+    if supabase is None:
         raise HTTPException(status_code=401, detail="Invalid or expired token")
+    return supabase
 
 
-def get_supabase_wb(access_token: str) -> SupabaseManager:
-    if access_token in supabase_manager_cache:
-        return supabase_manager_cache[access_token]
-    else:
+def get_supabase_wb(access_token: str) -> AsyncSupabaseManager:
+    supabase = open_session(session_store, access_token)
+    if supabase is None:
         raise HTTPException(status_code=401, detail="Invalid or expired token")
+    return supabase
 
 
 @supabase_router.get("/supabase/signin")
 async def signin(email: str, password: str) -> str:
     try:
-        supabase = SupabaseManager()
-        tokens = supabase.sign_in_with_password(email, password)
+        supabase = AsyncSupabaseManager()
+        tokens = await supabase.sign_in_with_password(email, password)
         logfire.info(f"sign in user: {tokens["user_id"]}")
 
-        supabase_manager_cache[tokens["access_token"]] = supabase
+        session_store.put(
+            tokens["access_token"], Session(tokens["user_id"], tokens["expires_at"])
+        )
         response = JSONResponse(content={"access_token": tokens["access_token"]})
 
         # リフレッシュトークンを HttpOnly Cookie に保存
@@ -68,11 +87,13 @@ async def signin(email: str, password: str) -> str:
 @supabase_router.get("/supabase/refresh")
 async def refresh(refresh_token: str = Cookie(...)) -> str:
     try:
-        supabase = SupabaseManager()
-        tokens = supabase.refresh_access_token(refresh_token)
+        supabase = AsyncSupabaseManager()
+        tokens = await supabase.refresh_access_token(refresh_token)
         logfire.info(f"refresh token user: {tokens["user_id"]}")
 
-        supabase_manager_cache[tokens["access_token"]] = supabase
+        session_store.put(
+            tokens["access_token"], Session(tokens["user_id"], tokens["expires_at"])
+        )
         return JSONResponse(content={"access_token": tokens["access_token"]})
     except HTTPException as e:
         raise e
@@ -82,11 +103,11 @@ async def refresh(refresh_token: str = Cookie(...)) -> str:
 async def signout(access_token=Depends(get_access_token)) -> str:
     try:
         supabase = get_supabase(access_token)
-        user_id = supabase.get_user_id()
-        supabase.supabase.auth.sign_out()
+        user_id = await supabase.get_user_id()
+        await supabase.sign_out()
         logfire.info(f"sign out user: {user_id}")
 
-        supabase_manager_cache.pop(access_token)
+        session_store.delete(access_token)
 
         # リフレッシュトークンを削除
         response = JSONResponse(content={"message": "Sign out"})
@@ -5,10 +5,18 @@ from pydantic_ai.messages import ModelMessage
 
 
 class ConversationScehma(BaseModel):
-    """all_messages() を保存する"""
+    """会話のメタデータ。messages は旧形式 (all_messages() の JSON) の場合のみ保存する"""
 
     id: int | None = None
     title: str
     user_id: str
-    messages: str
+    messages: str | None = None
     updated_at: str
+
+
+class ConversationMessageSchema(BaseModel):
+    """new_messages() を1件ずつ追記する"""
+
+    conversation_id: int
+    seq: int
+    message: dict
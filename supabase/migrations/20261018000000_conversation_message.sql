@@ -0,0 +1,35 @@
+-- One row per pydantic-ai ModelMessage, appended each turn instead of
+-- rewriting conversation.messages.
+create table if not exists public.conversation_message (
+    id bigint generated always as identity primary key,
+    conversation_id bigint not null references public.conversation (id) on delete cascade,
+    seq integer not null,
+    message jsonb not null,
+    created_at timestamptz not null default now(),
+    unique (conversation_id, seq)
+);
+
+alter table public.conversation_message enable row level security;
+
+create policy "conversation owner can read messages"
+    on public.conversation_message for select
+    using (exists (
+        select 1 from public.conversation c
+        where c.id = conversation_id and c.user_id::uuid = auth.uid()
+    ));
+
+create policy "conversation owner can append messages"
+    on public.conversation_message for insert
+    with check (exists (
+        select 1 from public.conversation c
+        where c.id = conversation_id and c.user_id::uuid = auth.uid()
+    ));
+
+-- Backfill from the legacy blob column, conversations not covered here are
+-- migrated lazily by managers.chat.get_conversation.
+insert into public.conversation_message (conversation_id, seq, message)
+select c.id, m.ordinality - 1, m.value
+from public.conversation c,
+    jsonb_array_elements(c.messages::jsonb) with ordinality as m
+where c.messages is not null
+on conflict (conversation_id, seq) do nothing;